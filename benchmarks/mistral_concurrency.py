@@ -0,0 +1,68 @@
+"""Compare how many slow completions the sync and async clients keep in flight
+
+The stub answers every request after --delay seconds, like a slow LLM. The
+sync path is measured with --workers threads (one per gunicorn sync worker),
+the async path with a single event loop. Usage:
+
+    python benchmarks/mistral_concurrency.py -n 200 --delay 0.5 --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tg_bot.settings")
+
+import django
+
+django.setup()
+
+from benchmarks.stub_server import start_stub
+from bot.mistral_client import MistralAPIClient
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def run_sync(client, count, workers):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda _: client.chat_completion("stub", MESSAGES), range(count)))
+    return time.perf_counter() - started
+
+
+async def run_async(client, count):
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(client.achat_completion("stub", MESSAGES) for _ in range(count))
+    )
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    server, base_url = start_stub(delay=args.delay)
+    client = MistralAPIClient("stub", base_url=base_url)
+
+    for name, elapsed in (
+        (
+            f"sync, {args.workers} workers",
+            run_sync(client, args.requests, args.workers),
+        ),
+        ("async, 1 event loop", asyncio.run(run_async(client, args.requests))),
+    ):
+        print(f"{name:<22} {elapsed:7.2f} s  {args.requests / elapsed:8.1f} req/s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
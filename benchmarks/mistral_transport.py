@@ -0,0 +1,82 @@
+"""Compare per-request latency of bare requests.post and the pooled session
+
+Runs against a local stub of the chat completions endpoint, so only the
+transport cost is measured: connection setup, TLS handshake and request
+framing. Usage:
+
+    python benchmarks/mistral_transport.py -n 500 --tls
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tg_bot.settings")
+
+import django
+
+django.setup()
+
+import requests
+
+from benchmarks.stub_server import start_stub
+from bot.mistral_client import MistralAPIClient
+
+
+def measure(call, count):
+    call()  # прогрев
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print(
+        f"{name:<20} mean {statistics.mean(samples):7.3f} ms  "
+        f"p50 {samples[len(samples) // 2]:7.3f} ms  "
+        f"p99 {samples[int(len(samples) * 0.99) - 1]:7.3f} ms"
+    )
+    return statistics.mean(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--requests", type=int, default=300)
+    parser.add_argument("--tls", action="store_true", help="serve the stub over TLS")
+    args = parser.parse_args()
+
+    server, base_url = start_stub(args.tls)
+    messages = [{"role": "user", "content": "Hello"}]
+    payload = {"model": "stub", "messages": messages}
+    headers = {"Authorization": "Bearer stub", "Content-Type": "application/json"}
+
+    def bare_post():
+        response = requests.post(
+            f"{base_url}/chat/completions",
+            headers=headers,
+            json=payload,
+            timeout=30,
+        )
+        response.raise_for_status()
+
+    client = MistralAPIClient("stub", base_url=base_url)
+
+    def pooled():
+        client.chat_completion("stub", messages)
+
+    bare = report("requests.post", measure(bare_post, args.requests))
+    shared = report("pooled session", measure(pooled, args.requests))
+    print(f"saved per request:   {bare - shared:7.3f} ms ({bare / shared:.1f}x)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Local stub of the Mistral chat completions endpoint used by benchmarks"""
+
+import json
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETION = json.dumps(
+    {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+
+    def setup(self):
+        super().setup()
+        # Заголовки и тело уходят разными write(): без NODELAY keep-alive
+        # соединение упирается в задержку Nagle + delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_stub(tls=False, delay=0.0):
+    """Serve the stub in a background thread, return server and base URL"""
+    handler = type("Handler", (StubHandler,), {"delay": delay})
+    server = StubServer(("127.0.0.1", 0), handler)
+    scheme = "http"
+    if tls:
+        directory = tempfile.mkdtemp()
+        cert, key = f"{directory}/cert.pem", f"{directory}/key.pem"
+        subprocess.run(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN=127.0.0.1",
+                "-addext",
+                "subjectAltName=IP:127.0.0.1",
+                "-keyout",
+                key,
+                "-out",
+                cert,
+            ],
+            check=True,
+            capture_output=True,
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        os.environ["REQUESTS_CA_BUNDLE"] = cert
+        os.environ["SSL_CERT_FILE"] = cert
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}/v1"
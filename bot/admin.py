@@ -1,5 +1,13 @@
 from django.contrib import admin
-from .models import Bot, Scenario, Step, BotSettings, Conversation, Message
+from .models import (
+    Bot,
+    Scenario,
+    Step,
+    BotSettings,
+    Conversation,
+    Message,
+    BroadcastJob,
+)
 
 
 @admin.register(Bot)
@@ -38,7 +46,13 @@ class ConversationAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ["conversation", "timestamp", "has_user_message", "has_bot_message"]
+    list_display = [
+        "conversation",
+        "timestamp",
+        "has_user_message",
+        "has_bot_message",
+        "latency_ms",
+    ]
     list_filter = ["timestamp"]
 
     def has_user_message(self, obj):
@@ -50,3 +64,10 @@ class MessageAdmin(admin.ModelAdmin):
         return bool(obj.bot_message)
 
     has_bot_message.boolean = True
+
+
+@admin.register(BroadcastJob)
+class BroadcastJobAdmin(admin.ModelAdmin):
+    list_display = ["bot", "status", "total", "sent", "failed", "created_at"]
+    list_filter = ["status", "created_at"]
+    search_fields = ["bot__name", "text"]
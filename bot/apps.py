@@ -1,3 +1,5 @@
+from importlib import import_module
+
 from django.apps import AppConfig
 
 
@@ -5,3 +7,7 @@ class BotsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "bot"
     verbose_name = "Bot Constructor"
+
+    def ready(self):
+        # Подключаем обработчики сигналов
+        import_module(f"{self.name}.signals")
@@ -0,0 +1,155 @@
+import gzip
+import json
+import logging
+import os
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .local_store import store_path
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+FIELDS = (
+    "id",
+    "conversation_id",
+    "step_id",
+    "user_message",
+    "bot_message",
+    "latency_ms",
+    "prompt_tokens",
+    "completion_tokens",
+    "timestamp",
+)
+
+
+class MessageArchive:
+    """Cold storage of one bot's messages on local disk
+
+    Messages go to append-only gzip'd NDJSON segments, one per month of
+    their timestamp. index.json lists the conversations of every segment,
+    so reading a conversation opens only the segments that contain it.
+    """
+
+    def __init__(self, bot_id):
+        self.directory = store_path(settings.BOT_ARCHIVE_DIR) / f"bot_{bot_id}"
+
+    def append(self, rows):
+        """Append message rows (dicts of FIELDS) and record them in the index"""
+        months = {}
+        for row in rows:
+            months.setdefault(f"{row['timestamp']:%Y-%m}", []).append(row)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        index = self.index()
+        for month, month_rows in months.items():
+            lines = "".join(
+                json.dumps(self._encode(row), ensure_ascii=False) + "\n"
+                for row in month_rows
+            )
+            # Each append is a complete gzip member, readers see the
+            # members of a segment as one stream
+            with open(self._segment(month), "ab") as segment:
+                segment.write(gzip.compress(lines.encode()))
+                segment.flush()
+                os.fsync(segment.fileno())
+
+            entry = index.setdefault(month, {"rows": 0, "conversations": {}})
+            entry["rows"] += len(month_rows)
+            for row in month_rows:
+                key = str(row["conversation_id"])
+                entry["conversations"][key] = entry["conversations"].get(key, 0) + 1
+        self._save_index(index)
+
+    def conversation_messages(self, conversation_id):
+        """Archived messages of a conversation as unsaved Message objects"""
+        key = str(conversation_id)
+        rows = {}
+        for month, entry in sorted(self.index().items()):
+            if key not in entry["conversations"]:
+                continue
+            for row in self._read(month):
+                # A rollover interrupted after the append leaves duplicates
+                if row["conversation_id"] == conversation_id:
+                    rows[row["id"]] = row
+
+        messages = [
+            Message(**dict(row, timestamp=parse_datetime(row["timestamp"])))
+            for row in rows.values()
+        ]
+        messages.sort(key=lambda message: (message.timestamp, message.id))
+        return messages
+
+    def rows(self, after_id=0):
+        """Archived rows above after_id as dicts of FIELDS
+
+        Segments are streamed line by line in the id order they were written
+        in, rows at or below the last one yielded are the duplicates an
+        interrupted rollover leaves.
+        """
+        last_id = after_id
+        for month in sorted(self.index()):
+            for row in self._read(month):
+                if row["id"] > last_id:
+                    last_id = row["id"]
+                    yield dict(row, timestamp=parse_datetime(row["timestamp"]))
+
+    def index(self):
+        try:
+            with open(self.directory / "index.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self, index):
+        path = self.directory / "index.json"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _segment(self, month):
+        return self.directory / f"{month}.ndjson.gz"
+
+    def _read(self, month):
+        try:
+            with gzip.open(self._segment(month), "rt", encoding="utf-8") as segment:
+                for line in segment:
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            # Хвост сегмента, оборванный на записи, пропускаем
+            logger.warning(f"Archive segment {self._segment(month)} is damaged: {e}")
+
+    def _encode(self, row):
+        return dict(row, timestamp=row["timestamp"].isoformat())
+
+
+def archive_bot_messages(bot_settings, batch_size=1000):
+    """Move messages older than the bot's archive_after_days to its archive
+
+    Every batch is appended to the archive before it is deleted from the
+    database. Returns the number of archived messages.
+    """
+    if not bot_settings.archive_after_days:
+        return 0
+
+    cutoff = timezone.now() - timedelta(days=bot_settings.archive_after_days)
+    archive = MessageArchive(bot_settings.bot_id)
+    old_messages = Message.objects.filter(
+        conversation__bot_id=bot_settings.bot_id, timestamp__lt=cutoff
+    ).order_by("id")
+
+    archived = 0
+    while True:
+        rows = list(old_messages.values(*FIELDS)[:batch_size])
+        if not rows:
+            return archived
+        archive.append(rows)
+        Message.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+        archived += len(rows)
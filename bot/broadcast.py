@@ -0,0 +1,113 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from django.db.models import F
+from django.utils import timezone
+
+from .delivery import get_delivery
+from .models import BroadcastJob, Conversation
+
+logger = logging.getLogger(__name__)
+
+# Как часто сохранять прогресс рассылки, секунд
+CHECKPOINT_INTERVAL = 1.0
+
+
+def run_broadcast(job, concurrency=30, batch_size=500, on_progress=None):
+    """Send the job's text to the remaining conversations of its bot
+
+    Recipients are read in batches of batch_size by id after the job's
+    checkpoint, at most concurrency sends are in flight and the flood
+    limits of TelegramDelivery apply. Every CHECKPOINT_INTERVAL seconds
+    the counters are saved and the checkpoint moves past the sends that
+    finished in recipient order, so a crashed run repeats only the sends
+    of the last interval and those in flight. Stops early when the job is
+    cancelled. Returns the job as last saved.
+    """
+    delivery = get_delivery()
+    token = job.bot.token
+    BroadcastJob.objects.filter(pk=job.pk, started_at__isnull=True).update(
+        started_at=timezone.now()
+    )
+    BroadcastJob.objects.filter(pk=job.pk, status="pending").update(status="running")
+    job.refresh_from_db()
+
+    recipients = Conversation.objects.filter(bot_id=job.bot_id, is_active=True)
+    progress = _Progress(job, on_progress)
+    last_id = job.last_conversation_id
+    running = job.status == "running"
+    while running:
+        batch = list(
+            recipients.filter(pk__gt=last_id)
+            .order_by("pk")
+            .values_list("pk", "user_identifier")[:batch_size]
+        )
+        if not batch:
+            BroadcastJob.objects.filter(pk=job.pk, status="running").update(
+                status="completed", finished_at=timezone.now()
+            )
+            break
+
+        pending = set()
+        for conversation_id, chat_id in batch:
+            if len(pending) >= concurrency:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                running = progress.advance()
+                if not running:
+                    break
+            future = delivery.queue_text(token, chat_id, job.text)
+            pending.add(future)
+            progress.add(conversation_id, future)
+        # Отмененная рассылка дожидается уже начатых отправок
+        wait(pending)
+        running = progress.advance(force=True) and running
+        last_id = batch[-1][0]
+
+    job.refresh_from_db()
+    return job
+
+
+class _Progress:
+    """Sends of a run, saved up to the first one still in flight"""
+
+    def __init__(self, job, on_progress=None):
+        self.job = job
+        self.on_progress = on_progress
+        self.sends = deque()
+        self.counts = {"sent": 0, "failed": 0}
+        self.last_id = None
+        self.saved_at = time.monotonic()
+
+    def add(self, conversation_id, future):
+        self.sends.append((conversation_id, future))
+
+    def advance(self, force=False):
+        """Save the finished prefix when due, False once the job stopped"""
+        while self.sends and self.sends[0][1].done():
+            conversation_id, future = self.sends.popleft()
+            if future.result().ok:
+                self.counts["sent"] += 1
+            else:
+                # Пользователь заблокировал бота или удалил чат
+                self.counts["failed"] += 1
+            self.last_id = conversation_id
+
+        due = time.monotonic() - self.saved_at >= CHECKPOINT_INTERVAL
+        if self.last_id is None or not (force or due):
+            return self.job.status == "running"
+
+        BroadcastJob.objects.filter(pk=self.job.pk).update(
+            last_conversation_id=self.last_id,
+            sent=F("sent") + self.counts["sent"],
+            failed=F("failed") + self.counts["failed"],
+            updated_at=timezone.now(),
+        )
+        self.counts = {"sent": 0, "failed": 0}
+        self.last_id = None
+        self.saved_at = time.monotonic()
+        self.job.refresh_from_db()
+        if self.on_progress:
+            self.on_progress(self.job)
+        return self.job.status == "running"
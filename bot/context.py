@@ -0,0 +1,65 @@
+import math
+
+# Role markers and separators Mistral adds around every chat message
+MESSAGE_OVERHEAD = 4
+# Characters of one message kept in the rolling summary
+SUMMARY_LINE_CHARS = 200
+
+
+def estimate_tokens(text):
+    """Cheap local upper estimate of the tokens Mistral spends on text
+
+    About four bytes of UTF-8 per token, which stays on the safe side for
+    Cyrillic text as well.
+    """
+    return math.ceil(len(text.encode()) / 4)
+
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def history_messages(entries):
+    """Chat messages of history entries (id, user_message, bot_message)"""
+    messages = []
+    for _, user_text, bot_text in entries:
+        if user_text:
+            messages.append({"role": "user", "content": user_text})
+        if bot_text:
+            messages.append({"role": "assistant", "content": bot_text})
+    return messages
+
+
+def fit_history(entries, budget):
+    """Split history into the entries left out and the newest ones fitting budget"""
+    used = 0
+    start = len(entries)
+    for index in range(len(entries) - 1, -1, -1):
+        cost = sum(message_tokens(m) for m in history_messages([entries[index]]))
+        if used + cost > budget:
+            break
+        used += cost
+        start = index
+    return entries[:start], entries[start:]
+
+
+def fold_summary(summary, entries, max_tokens):
+    """Add entries to a rolling summary, forgetting its oldest lines first"""
+    lines = summary.splitlines() if summary else []
+    for _, user_text, bot_text in entries:
+        if user_text:
+            lines.append(f"User: {_shorten(user_text)}")
+        if bot_text:
+            lines.append(f"Assistant: {_shorten(bot_text)}")
+
+    total = sum(estimate_tokens(line) + 1 for line in lines)
+    while lines and total > max_tokens:
+        total -= estimate_tokens(lines.pop(0)) + 1
+    return "\n".join(lines)
+
+
+def _shorten(text):
+    text = " ".join(text.split())
+    if len(text) <= SUMMARY_LINE_CHARS:
+        return text
+    return text[: SUMMARY_LINE_CHARS - 1] + "…"
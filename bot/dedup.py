@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from .local_store import LocalStore, store_path
+
+logger = logging.getLogger(__name__)
+
+
+class SeenUpdates(LocalStore):
+    """Recent update_ids of every bot and the highest one seen
+
+    Ids more than window below the high-water mark are pruned and treated
+    as seen: Telegram only redelivers updates it is still holding.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS high_water (
+        bot_key TEXT PRIMARY KEY,
+        update_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS recent_updates (
+        bot_key TEXT NOT NULL,
+        update_id INTEGER NOT NULL,
+        PRIMARY KEY (bot_key, update_id)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, window=1000):
+        super().__init__(path)
+        self.window = window
+
+    def claim(self, bot_key, update_id):
+        """Record update_id, False when it was seen before"""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT update_id FROM high_water WHERE bot_key = ?", (bot_key,)
+            ).fetchone()
+            if row and update_id <= row[0] - self.window:
+                return False
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO recent_updates (bot_key, update_id) "
+                "VALUES (?, ?)",
+                (bot_key, update_id),
+            ).rowcount
+            if not inserted:
+                return False
+            if row is None or update_id > row[0]:
+                conn.execute(
+                    "INSERT OR REPLACE INTO high_water (bot_key, update_id) "
+                    "VALUES (?, ?)",
+                    (bot_key, update_id),
+                )
+                conn.execute(
+                    "DELETE FROM recent_updates WHERE bot_key = ? AND update_id <= ?",
+                    (bot_key, update_id - self.window),
+                )
+        return True
+
+    def release(self, bot_key, update_id):
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM recent_updates WHERE bot_key = ? AND update_id = ?",
+                (bot_key, update_id),
+            )
+
+
+class UpdateDeduplicator:
+    """Drops redelivered Telegram updates before any work is done
+
+    Each process remembers the last window update_ids of every bot, so
+    a redelivery to the same process is rejected without I/O. An update
+    the process has not seen is claimed in SeenUpdates, shared by all
+    worker processes and kept across restarts.
+    """
+
+    def __init__(self, store, window=1000):
+        self.store = store
+        self.window = window
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._stats = {"claimed": 0, "duplicates": 0}
+
+    def claim(self, bot_token, update_data):
+        """True when the update should be processed, False for a duplicate"""
+        update_id = update_data.get("update_id")
+        if update_id is None:
+            return True
+
+        bot_key = self._bot_key(bot_token)
+        with self._lock:
+            ids, seen = self._recent.setdefault(bot_key, (deque(), set()))
+            claimed = update_id not in seen
+        if claimed:
+            # Первая доставка в этот процесс: другой мог ее уже принять
+            claimed = self.store.claim(bot_key, update_id)
+            with self._lock:
+                if update_id not in seen:
+                    ids.append(update_id)
+                    seen.add(update_id)
+                    if len(ids) > self.window:
+                        seen.discard(ids.popleft())
+
+        if not claimed:
+            self._count("duplicates")
+            logger.info(f"Skipping redelivered update {update_id}")
+            return False
+        self._count("claimed")
+        return True
+
+    def release(self, bot_token, update_data):
+        """Forget a claimed update that was not accepted after all"""
+        update_id = update_data.get("update_id")
+        if update_id is None:
+            return
+        bot_key = self._bot_key(bot_token)
+        with self._lock:
+            _, seen = self._recent.get(bot_key, (None, set()))
+            # Остается в deque до вытеснения, на проверку это не влияет
+            seen.discard(update_id)
+        self.store.release(bot_key, update_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, bots=len(self._recent))
+
+    def _bot_key(self, bot_token):
+        return hashlib.sha256(bot_token.encode()).hexdigest()[:16]
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+_dedup = None
+_dedup_lock = threading.Lock()
+
+
+def get_update_dedup():
+    """Process-wide UpdateDeduplicator configured from settings"""
+    global _dedup
+    if _dedup is None:
+        with _dedup_lock:
+            if _dedup is None:
+                window = settings.BOT_UPDATE_DEDUP_WINDOW
+                _dedup = UpdateDeduplicator(
+                    SeenUpdates(store_path(settings.BOT_UPDATE_DEDUP_FILE), window),
+                    window,
+                )
+    return _dedup
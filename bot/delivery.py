@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+
+import telegram
+from django.conf import settings
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+
+from .rate_limit import get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def split_text(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Cut text into ordered chunks of at most limit characters
+
+    Chunks end at a line break, else at a space, when there is one.
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            chunks.append(text[:limit])
+            text = text[limit:]
+        else:
+            chunks.append(text[:cut])
+            text = text[cut + 1 :]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+@dataclass
+class DeliveryResult:
+    """Outcome of one Bot API call made on the delivery loop"""
+
+    ok: bool
+    result: object = None
+    error: Exception = None
+    latency: float = 0.0
+
+    def unwrap(self):
+        """Result of the call, or its exception raised"""
+        if not self.ok:
+            raise self.error
+        return self.result
+
+
+class TelegramDelivery:
+    """Bot API calls for synchronous code, run on one long-lived event loop
+
+    python-telegram-bot methods are coroutines; sync callers hand them to
+    the loop thread of this class and wait for the result or collect the
+    futures of many concurrent calls. All bots share one pooled HTTP
+    transport, so connections are reused between calls.
+
+    Messages to chats go through limited(): token buckets shared by the
+    worker processes keep every bot under TELEGRAM_BOT_RATE messages per
+    second and every chat under TELEGRAM_CHAT_RATE, a 429 pauses the bot
+    for its retry_after, and failed calls are retried with jitter.
+    """
+
+    def __init__(self, pool_size):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="telegram-delivery", daemon=True
+        )
+        self._thread.start()
+        # The transport must be created on the loop it is used from
+        self._request = self.run(self._create_request(pool_size))
+        self._bots = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "failed": 0,
+            "retried": 0,
+            "flood_waits": 0,
+            "total_latency": 0.0,
+        }
+        # Used from the loop thread only
+        self._chat_locks = weakref.WeakValueDictionary()
+        self._resume_at = {}
+
+    def bot(self, token):
+        """telegram.Bot bound to the shared transport, for use on the loop"""
+        bot = self._bots.get(token)
+        if bot is None:
+            with self._lock:
+                bot = self._bots.get(token)
+                if bot is None:
+                    bot = telegram.Bot(
+                        token, request=self._request, get_updates_request=self._request
+                    )
+                    self._bots[token] = bot
+        return bot
+
+    def submit(self, coroutine):
+        """Schedule coroutine on the loop, return a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(self, coroutine, timeout=None):
+        """Run coroutine on the loop and wait for its result"""
+        return self.submit(coroutine).result(timeout)
+
+    def call(self, token, method, **kwargs):
+        """Start a Bot API call, return a Future of its DeliveryResult"""
+        return self.submit(self._timed(getattr(self.bot(token), method)(**kwargs)))
+
+    def send(self, token, method, **kwargs):
+        """Make a Bot API call and wait for its DeliveryResult"""
+        return self.call(token, method, **kwargs).result(
+            settings.TELEGRAM_DELIVERY_TIMEOUT
+        )
+
+    def queue_text(self, token, chat_id, text, **kwargs):
+        """Start sending text to a chat, return a Future of its DeliveryResult
+
+        The result is the list of sent messages, one per chunk.
+        """
+        return self.submit(self._timed(self.send_text(token, chat_id, text, **kwargs)))
+
+    def outbound(self, token):
+        """Rate-limited stand-in for the bot's telegram.Bot"""
+        return OutboundBot(self, token)
+
+    async def send_text(self, token, chat_id, text, reply_to_message_id=None, **kwargs):
+        """Send text as ordered chunks that fit a Telegram message
+
+        Chunks of one call are never interleaved with other messages sent
+        to the chat through this method. Only the first chunk is a reply.
+        """
+        messages = []
+        async with self._chat_lock(token, chat_id):
+            for chunk in split_text(text):
+                messages.append(
+                    await self.limited(
+                        token,
+                        "send_message",
+                        chat_id=chat_id,
+                        text=chunk,
+                        reply_to_message_id=reply_to_message_id,
+                        **kwargs,
+                    )
+                )
+                reply_to_message_id = None
+        return messages
+
+    async def limited(self, token, method, **kwargs):
+        """Bot API call within the flood limits, retried until it goes through
+
+        Must run on the delivery loop.
+        """
+        bot = self.bot(token)
+        for attempt in range(settings.TELEGRAM_SEND_RETRIES + 1):
+            await self._throttle(token, kwargs.get("chat_id"))
+            try:
+                return await getattr(bot, method)(**kwargs)
+            except RetryAfter as e:
+                if attempt == settings.TELEGRAM_SEND_RETRIES:
+                    raise
+                # Telegram блокирует бота целиком: ждем ровно retry_after
+                # и немного сверху, чтобы ожидавшие не ударили разом
+                self._resume_at[token] = time.monotonic() + e.retry_after
+                delay = random.uniform(0, 0.5)
+                self._count("flood_waits")
+            except NetworkError as e:
+                if isinstance(e, BadRequest) or (
+                    attempt == settings.TELEGRAM_SEND_RETRIES
+                ):
+                    raise
+                delay = min(2**attempt, 30) * random.uniform(0.5, 1.5)
+            logger.warning(f"Telegram {method} failed, retrying in {delay:.1f}s")
+            self._count("retried")
+            await asyncio.sleep(delay)
+
+    def close(self):
+        """Close the shared transport and stop the loop thread"""
+        self.run(self._request.shutdown())
+        self.run(self._loop.shutdown_default_executor())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        total = stats.pop("total_latency")
+        stats["avg_latency_ms"] = (
+            round(total / stats["calls"] * 1000, 1) if stats["calls"] else 0.0
+        )
+        stats["bots"] = len(self._bots)
+        return stats
+
+    def _chat_lock(self, token, chat_id):
+        lock = self._chat_locks.get((token, chat_id))
+        if lock is None:
+            lock = self._chat_locks[(token, chat_id)] = asyncio.Lock()
+        return lock
+
+    async def _throttle(self, token, chat_id):
+        pause = self._resume_at.get(token, 0) - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+        # Сообщения не отбрасываются: ждем токен сколько потребуется
+        limiter = get_rate_limiter()
+        bot_key = f"telegram:bot:{hashlib.sha256(token.encode()).hexdigest()[:16]}"
+        if chat_id is not None:
+            await limiter.aacquire(
+                f"{bot_key}:chat:{chat_id}",
+                settings.TELEGRAM_CHAT_RATE * 60,
+                math.inf,
+                burst=1,
+            )
+        await limiter.aacquire(
+            bot_key,
+            settings.TELEGRAM_BOT_RATE * 60,
+            math.inf,
+            burst=settings.TELEGRAM_BOT_RATE,
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    async def _create_request(self, pool_size):
+        return HTTPXRequest(connection_pool_size=pool_size)
+
+    async def _timed(self, coroutine):
+        started = time.monotonic()
+        try:
+            result = DeliveryResult(ok=True, result=await coroutine)
+        except Exception as e:
+            logger.warning(f"Telegram call failed: {e}")
+            result = DeliveryResult(ok=False, error=e)
+        result.latency = time.monotonic() - started
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["failed"] += int(not result.ok)
+            self._stats["total_latency"] += result.latency
+        return result
+
+
+class OutboundBot:
+    """The send_message and edit_message_text of a bot, rate-limited
+
+    Calls run on the delivery loop whichever event loop awaits them.
+    """
+
+    def __init__(self, delivery, token):
+        self.delivery = delivery
+        self.token = token
+
+    async def send_message(self, **kwargs):
+        return await self._call("send_message", **kwargs)
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self._call("edit_message_text", text=text, **kwargs)
+
+    async def _call(self, method, **kwargs):
+        coroutine = self.delivery.limited(self.token, method, **kwargs)
+        return await asyncio.wrap_future(self.delivery.submit(coroutine))
+
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+
+def get_delivery():
+    """Process-wide TelegramDelivery configured from settings"""
+    global _delivery
+    if _delivery is None:
+        with _delivery_lock:
+            if _delivery is None:
+                _delivery = TelegramDelivery(settings.TELEGRAM_POOL_SIZE)
+    return _delivery
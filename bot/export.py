@@ -0,0 +1,124 @@
+import heapq
+import zlib
+from itertools import islice
+from operator import itemgetter
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .archive import MessageArchive
+from .models import Conversation, Message
+
+FIELDS = {
+    "id": "id",
+    "bot": "conversation__bot_id",
+    "conversation": "conversation_id",
+    "user_identifier": "conversation__user_identifier",
+    "step": "step_id",
+    "user_message": "user_message",
+    "bot_message": "bot_message",
+    "latency_ms": "latency_ms",
+    "prompt_tokens": "prompt_tokens",
+    "completion_tokens": "completion_tokens",
+    "timestamp": "timestamp",
+}
+
+
+def export_rows(bot_ids, since=None, until=None, after_id=0, chunk_size=2000):
+    """Messages of the bots in id order, one dict per message
+
+    Rows are streamed from the database chunk by chunk and merged with
+    the messages moved to the bots' archives. after_id is the resume
+    cursor: pass the id of the last row already received.
+    """
+    queryset = Message.objects.filter(
+        conversation__bot_id__in=bot_ids, id__gt=after_id
+    ).order_by("id")
+    if since:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+
+    names = list(FIELDS)
+    rows = queryset.values_list(*FIELDS.values())
+    hot = (dict(zip(names, row)) for row in rows.iterator(chunk_size=chunk_size))
+    archived = [
+        _archived_rows(bot_id, since, until, after_id, chunk_size) for bot_id in bot_ids
+    ]
+
+    last_id = None
+    for row in heapq.merge(hot, *archived, key=itemgetter("id")):
+        # Прерванный перенос в архив оставляет строку в обоих местах
+        if row["id"] != last_id:
+            last_id = row["id"]
+            yield row
+
+
+def _archived_rows(bot_id, since, until, after_id, chunk_size):
+    rows = (
+        row
+        for row in MessageArchive(bot_id).rows(after_id)
+        if (not since or row["timestamp"] >= since)
+        and (not until or row["timestamp"] < until)
+    )
+    while chunk := list(islice(rows, chunk_size)):
+        # Диалоги остаются в базе, архивируются только сообщения
+        users = dict(
+            Conversation.objects.filter(
+                pk__in={row["conversation_id"] for row in chunk}
+            ).values_list("pk", "user_identifier")
+        )
+        for row in chunk:
+            yield {
+                "id": row["id"],
+                "bot": bot_id,
+                "conversation": row["conversation_id"],
+                "user_identifier": users.get(row["conversation_id"]),
+                "step": row["step_id"],
+                "user_message": row["user_message"],
+                "bot_message": row["bot_message"],
+                "latency_ms": row["latency_ms"],
+                "prompt_tokens": row["prompt_tokens"],
+                "completion_tokens": row["completion_tokens"],
+                "timestamp": row["timestamp"],
+            }
+
+
+def ndjson(rows, buffer_size=64 * 1024):
+    """Encode rows as NDJSON, yielding bytes in blocks of about buffer_size"""
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    buffer = []
+    size = 0
+    for row in rows:
+        line = (encoder.encode(row) + "\n").encode()
+        buffer.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzipped(blocks):
+    """Compress a stream of bytes blocks into a single gzip stream"""
+    compressor = zlib.compressobj(wbits=31)  # 16 + MAX_WBITS - gzip header
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_time(value):
+    """Aware datetime of an ISO 8601 string, None for an empty value"""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid datetime: {value}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import OuterRef, Subquery
+
+from .models import Message
+
+# Последнее сообщение диалога не известно, буфер берется из кэша как есть
+UNCHECKED = object()
+
+
+def _cache():
+    return caches[settings.BOT_HISTORY_CACHE]
+
+
+def history_key(conversation_id):
+    return f"bot:history:{conversation_id}"
+
+
+def _newest(messages):
+    # Exchanges stored within the same instant keep their order by id
+    return messages.order_by("-timestamp", "-id")
+
+
+def _query(conversation_id):
+    return _newest(Message.objects.filter(conversation_id=conversation_id)).values_list(
+        "id", "user_message", "bot_message"
+    )[: settings.BOT_HISTORY_SIZE]
+
+
+def last_message_id():
+    """Subquery for the id of a conversation's newest message
+
+    Annotate the conversation with it and pass the value to recent_history
+    to catch a buffer that missed turns stored by another process.
+    """
+    return Subquery(
+        _newest(Message.objects.filter(conversation=OuterRef("pk"))).values("id")[:1]
+    )
+
+
+def _stale(history, last_id):
+    if history is None:
+        return True
+    if last_id is UNCHECKED:
+        return False
+    return (history[-1][0] if history else None) != last_id
+
+
+def recent_history(conversation_id, last_id=UNCHECKED):
+    """Last BOT_HISTORY_SIZE rows as (id, user_message, bot_message), oldest first
+
+    Served from the cache for active chats, a miss loads the history from
+    the database once and caches it. With last_id, the conversation's
+    newest message id, a cached buffer ending elsewhere is loaded again.
+    """
+    cache = _cache()
+    history = cache.get(history_key(conversation_id))
+    if _stale(history, last_id):
+        history = list(reversed(_query(conversation_id)))
+        cache.set(history_key(conversation_id), history, settings.BOT_HISTORY_TTL)
+    return history
+
+
+async def arecent_history(conversation_id, last_id=UNCHECKED):
+    cache = _cache()
+    history = await cache.aget(history_key(conversation_id))
+    if _stale(history, last_id):
+        history = [row async for row in _query(conversation_id)]
+        history.reverse()
+        await cache.aset(
+            history_key(conversation_id), history, settings.BOT_HISTORY_TTL
+        )
+    return history
+
+
+def _evicted(conversation_id, after_id, before_id):
+    return _newest(
+        Message.objects.filter(
+            conversation_id=conversation_id, id__gt=after_id, id__lt=before_id
+        )
+    ).values_list("id", "user_message", "bot_message")[: settings.BOT_HISTORY_SIZE]
+
+
+def evicted_history(conversation_id, after_id, before_id):
+    """Rows between after_id and before_id that left the ring buffer, oldest first
+
+    Only the newest BOT_HISTORY_SIZE of them, older lines would not survive
+    in the rolling summary anyway.
+    """
+    return list(reversed(_evicted(conversation_id, after_id, before_id)))
+
+
+async def aevicted_history(conversation_id, after_id, before_id):
+    rows = [row async for row in _evicted(conversation_id, after_id, before_id)]
+    rows.reverse()
+    return rows
+
+
+def append_history(conversation_id, entries, created=False):
+    """Write stored messages through to the cached ring buffer
+
+    Call after the messages are committed. A conversation created together
+    with its messages has nothing else in its history, otherwise a buffer
+    that is not cached is left to be loaded from the database on demand.
+    """
+    cache = _cache()
+    key = history_key(conversation_id)
+    history = [] if created else cache.get(key)
+    if history is None:
+        return
+    history = (history + list(entries))[-settings.BOT_HISTORY_SIZE :]
+    cache.set(key, history, settings.BOT_HISTORY_TTL)
+
+
+def drop_history(conversation_id):
+    _cache().delete(history_key(conversation_id))
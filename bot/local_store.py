@@ -0,0 +1,55 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+
+def store_path(name):
+    """Return path of a local store file inside BOT_LOCAL_STORE_DIR"""
+    directory = Path(settings.BOT_LOCAL_STORE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / name
+
+
+class LocalStore:
+    """SQLite file shared by every thread and worker process on the host"""
+
+    schema = ""
+    synchronous = "NORMAL"
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """Per-thread connection, created lazily together with the schema"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            if self.schema:
+                conn.executescript(self.schema)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction that takes the database lock up front"""
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from bot.archive import archive_bot_messages
+from bot.models import BotSettings
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than each bot's archive_after_days from the "
+        "messages table to compressed monthly archive segments. "
+        "Run a single instance at a time, e.g. nightly from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bot", type=int, help="Archive only this bot id")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        bot_settings = BotSettings.objects.filter(archive_after_days__gt=0)
+        if options["bot"]:
+            bot_settings = bot_settings.filter(bot_id=options["bot"])
+
+        for item in bot_settings.order_by("bot_id"):
+            archived = archive_bot_messages(item, options["batch_size"])
+            if archived:
+                self.stdout.write(f"Bot {item.bot_id}: archived {archived} messages")
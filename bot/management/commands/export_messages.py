@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.export import export_rows, gzipped, ndjson, parse_time
+from bot.models import Bot
+
+
+class Command(BaseCommand):
+    help = (
+        "Export messages as NDJSON in id order. Resume an interrupted export "
+        "with --after-id set to the id of the last exported row."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bot", type=int, action="append", help="Bot id")
+        parser.add_argument("--since", help="ISO 8601, inclusive")
+        parser.add_argument("--until", help="ISO 8601, exclusive")
+        parser.add_argument("--after-id", type=int, default=0)
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--output", help="File to write, stdout by default")
+
+    def handle(self, *args, **options):
+        bot_ids = options["bot"] or list(Bot.objects.values_list("id", flat=True))
+        try:
+            since = parse_time(options["since"])
+            until = parse_time(options["until"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        stream = ndjson(
+            export_rows(
+                bot_ids, since, until, options["after_id"], options["chunk_size"]
+            )
+        )
+        if options["gzip"]:
+            stream = gzipped(stream)
+
+        if options["output"]:
+            with open(options["output"], "wb") as output:
+                output.writelines(stream)
+        else:
+            sys.stdout.buffer.writelines(stream)
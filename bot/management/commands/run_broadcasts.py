@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bot.broadcast import run_broadcast
+from bot.models import BroadcastJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Send pending broadcast jobs and resume the interrupted ones. "
+        "Run a single instance at a time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--job", type=int, help="Run only this job id")
+        parser.add_argument("--concurrency", type=int, default=30)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--watch",
+            type=int,
+            metavar="SECONDS",
+            help="Keep running, looking for new jobs every SECONDS",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = BroadcastJob.objects.filter(
+                status__in=["pending", "running"]
+            ).select_related("bot")
+            if options["job"]:
+                jobs = jobs.filter(pk=options["job"])
+
+            for job in jobs.order_by("pk"):
+                job = run_broadcast(
+                    job,
+                    concurrency=options["concurrency"],
+                    batch_size=options["batch_size"],
+                    on_progress=self.report,
+                )
+                self.stdout.write(
+                    f"Broadcast {job.pk}: {job.status}, "
+                    f"{job.sent} sent, {job.failed} failed"
+                )
+
+            if not options["watch"]:
+                return
+            time.sleep(options["watch"])
+
+    def report(self, job):
+        eta = "unknown" if job.eta_seconds is None else f"{job.eta_seconds}s"
+        self.stdout.write(
+            f"Broadcast {job.pk}: {job.sent + job.failed}/{job.total}, "
+            f"{job.throughput} msg/s, ETA {eta}"
+        )
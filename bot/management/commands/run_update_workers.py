@@ -0,0 +1,38 @@
+import logging
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bot.registry import registry
+from bot.update_queue import UpdateDispatcher, get_update_queue
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Process Telegram updates stored by the webhook in queue mode. "
+        "Updates of one chat are handled in order, different chats in parallel; "
+        "run a single instance per queue file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.BOT_UPDATE_WORKERS)
+
+    def handle(self, *args, **options):
+        queue = get_update_queue()
+        registry.warm()
+        dispatcher = UpdateDispatcher(queue, workers=options["workers"])
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+        dispatcher.start()
+        self.stdout.write(
+            f"Started {options['workers']} shard workers, queue depth {queue.depth()}"
+        )
+        while not stop.wait(60):
+            logger.info(f"Update queue depth: {queue.depth()}")
+        dispatcher.stop()
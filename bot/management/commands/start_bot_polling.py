@@ -0,0 +1,34 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from bot.polling import PollingSupervisor
+
+
+class Command(BaseCommand):
+    help = (
+        "Long-poll getUpdates for every active Telegram bot in one process "
+        "and feed the updates into the webhook pipeline. For deployments "
+        "without public ingress; run a single instance."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--delete-webhooks",
+            action="store_true",
+            help="Delete webhooks first, Telegram refuses getUpdates while one is set",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.poll(options["delete_webhooks"]))
+
+    async def poll(self, delete_webhooks):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+
+        self.stdout.write("Polling started")
+        await PollingSupervisor(delete_webhooks).run(stop)
+        self.stdout.write("Polling stopped")
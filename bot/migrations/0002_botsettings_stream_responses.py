@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="botsettings",
+            name="stream_responses",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0002_botsettings_stream_responses"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="botsettings",
+            name="cache_responses",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="botsettings",
+            name="cache_ttl",
+            field=models.PositiveIntegerField(default=3600),
+        ),
+    ]
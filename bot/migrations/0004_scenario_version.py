@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0003_botsettings_response_cache"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="version",
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
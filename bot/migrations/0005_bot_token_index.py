@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0004_scenario_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="bot",
+            name="token",
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+    ]
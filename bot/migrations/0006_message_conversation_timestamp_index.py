@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0005_bot_token_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["conversation", "timestamp"], name="messages_convers_31a2d0_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0006_message_conversation_timestamp_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="botsettings",
+            name="context_token_budget",
+            field=models.PositiveIntegerField(default=2000),
+        ),
+    ]
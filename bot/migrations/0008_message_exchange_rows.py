@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0007_botsettings_context_token_budget"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="completion_tokens",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="latency_ms",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="prompt_tokens",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
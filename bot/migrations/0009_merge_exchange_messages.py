@@ -0,0 +1,83 @@
+from django.db import migrations, transaction
+
+CONVERSATIONS_PER_CHUNK = 500
+# Merged pairs written per transaction, keeps the DELETE under the
+# database's limit of bound parameters
+ROWS_PER_FLUSH = 500
+
+
+def merge_exchanges(apps, schema_editor):
+    """Fold each bot-only row into the user-only row right before it
+
+    Reads the messages a chunk of conversations at a time and writes every
+    ROWS_PER_FLUSH merged pairs in their own transaction, so a large
+    messages table is converted without one long lock and an interrupted
+    run can simply be restarted.
+    """
+    Conversation = apps.get_model("bot", "Conversation")
+    Message = apps.get_model("bot", "Message")
+    db_alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        conversation_ids = list(
+            Conversation.objects.using(db_alias)
+            .filter(pk__gt=last_id)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:CONVERSATIONS_PER_CHUNK]
+        )
+        if not conversation_ids:
+            break
+        last_id = conversation_ids[-1]
+
+        merged = []
+        answer_ids = []
+        previous = None
+        rows = (
+            Message.objects.using(db_alias)
+            .filter(conversation_id__in=conversation_ids)
+            .order_by("conversation_id", "timestamp", "pk")
+            .only("conversation_id", "step_id", "user_message", "bot_message")
+        )
+        for row in rows.iterator(chunk_size=2000):
+            if (
+                previous is not None
+                and previous.conversation_id == row.conversation_id
+                and previous.step_id == row.step_id
+                and previous.user_message
+                and not previous.bot_message
+                and row.bot_message
+                and not row.user_message
+            ):
+                previous.bot_message = row.bot_message
+                merged.append(previous)
+                answer_ids.append(row.pk)
+                previous = None
+                if len(merged) >= ROWS_PER_FLUSH:
+                    _flush(Message, db_alias, merged, answer_ids)
+                    merged, answer_ids = [], []
+            else:
+                previous = row
+        _flush(Message, db_alias, merged, answer_ids)
+
+
+def _flush(Message, db_alias, merged, answer_ids):
+    """Save merged questions and delete their answer rows in one transaction"""
+    if not merged:
+        return
+    with transaction.atomic(using=db_alias):
+        Message.objects.using(db_alias).bulk_update(merged, ["bot_message"])
+        Message.objects.using(db_alias).filter(pk__in=answer_ids).delete()
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("bot", "0008_message_exchange_rows"),
+    ]
+
+    operations = [
+        # Merged rows read the same in the old code, nothing to undo
+        migrations.RunPython(merge_exchanges, migrations.RunPython.noop),
+    ]
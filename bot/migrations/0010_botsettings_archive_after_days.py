@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0009_merge_exchange_messages"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="botsettings",
+            name="archive_after_days",
+            field=models.PositiveIntegerField(default=90),
+        ),
+    ]
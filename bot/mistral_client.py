@@ -1,31 +1,188 @@
+import asyncio
+import json
+import socket
+import threading
+import weakref
+
+import httpx
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+FALLBACK_RESPONSE = "I'm sorry, I'm having trouble processing your request right now."
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _socket_options():
+    options = list(HTTPConnection.default_socket_options)
+    idle = settings.MISTRAL_HTTP_KEEPALIVE
+    if idle:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            options.extend(
+                [
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle),
+                ]
+            )
+    return options
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_http_session():
+    """Process-wide keep-alive session shared by every Mistral client"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = _KeepAliveAdapter(
+                    pool_connections=1, pool_maxsize=settings.MISTRAL_HTTP_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_http_client():
+    """Keep-alive httpx client shared by all coroutines of the running loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.MISTRAL_ASYNC_MAX_CONNECTIONS,
+                keepalive_expiry=settings.MISTRAL_HTTP_KEEPALIVE or None,
+            ),
+            timeout=httpx.Timeout(
+                settings.MISTRAL_READ_TIMEOUT, connect=settings.MISTRAL_CONNECT_TIMEOUT
+            ),
+        )
+        _async_clients[loop] = client
+    return client
 
 
 class MistralAPIClient:
-    def __init__(self, api_key):
+    def __init__(self, api_key, base_url=None):
         self.api_key = api_key
-        self.base_url = "https://api.mistral.ai/v1"
+        self.base_url = base_url or settings.MISTRAL_API_URL
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
         }
+        self.session = get_http_session()
+        self.timeout = (settings.MISTRAL_CONNECT_TIMEOUT, settings.MISTRAL_READ_TIMEOUT)
 
-    def chat_completion(self, model, messages, max_tokens=500, temperature=0.7):
-        """Make chat completion request to Mistral API"""
+    def chat_completion(
+        self, model, messages, max_tokens=500, temperature=0.7, usage=None
+    ):
+        """Make chat completion request to Mistral API
+
+        Token usage reported by the API is copied into the usage dict.
+        """
         url = f"{self.base_url}/chat/completions"
+        data = self._payload(model, messages, max_tokens, temperature)
 
-        data = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-        }
+        try:
+            response = self.session.post(
+                url, headers=self.headers, json=data, timeout=self.timeout
+            )
+            response.raise_for_status()
+            result = response.json()
+            self._record_usage(result, usage)
+            return result["choices"][0]["message"]["content"]
+        except Exception as e:
+            print(f"Mistral API request failed: {e}")
+            return FALLBACK_RESPONSE
+
+    async def achat_completion(
+        self, model, messages, max_tokens=500, temperature=0.7, usage=None
+    ):
+        """Make chat completion request to Mistral API without blocking the loop"""
+        url = f"{self.base_url}/chat/completions"
+        data = self._payload(model, messages, max_tokens, temperature)
 
         try:
-            response = requests.post(url, headers=self.headers, json=data, timeout=30)
+            response = await get_async_http_client().post(
+                url, headers=self.headers, json=data
+            )
             response.raise_for_status()
             result = response.json()
+            self._record_usage(result, usage)
             return result["choices"][0]["message"]["content"]
         except Exception as e:
             print(f"Mistral API request failed: {e}")
-            return "I'm sorry, I'm having trouble processing your request right now."
+            return FALLBACK_RESPONSE
+
+    def stream_chat_completion(
+        self, model, messages, max_tokens=500, temperature=0.7, usage=None
+    ):
+        """Yield text chunks of a streamed chat completion as they arrive"""
+        url = f"{self.base_url}/chat/completions"
+        data = self._payload(model, messages, max_tokens, temperature)
+        data["stream"] = True
+
+        with self.session.post(
+            url, headers=self.headers, json=data, timeout=self.timeout, stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                chunk = self._parse_event(line, usage)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+
+    async def astream_chat_completion(
+        self, model, messages, max_tokens=500, temperature=0.7, usage=None
+    ):
+        """Yield text chunks of a streamed chat completion from a coroutine"""
+        url = f"{self.base_url}/chat/completions"
+        data = self._payload(model, messages, max_tokens, temperature)
+        data["stream"] = True
+
+        async with get_async_http_client().stream(
+            "POST", url, headers=self.headers, json=data
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                chunk = self._parse_event(line, usage)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+
+    def _parse_event(self, line, usage=None):
+        """Text delta of one SSE line, None at the end of the stream"""
+        if not line or not line.startswith("data:"):
+            return ""
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return None
+        event = json.loads(data)
+        # Mistral reports usage with the last chunk of the stream
+        self._record_usage(event, usage)
+        choices = event.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def _record_usage(self, result, usage):
+        if usage is not None and result.get("usage"):
+            usage.update(result["usage"])
+
+    def _payload(self, model, messages, max_tokens, temperature):
+        return {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
@@ -11,7 +11,8 @@ class Bot(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     bot_type = models.CharField(max_length=20, choices=BOT_TYPES, default="telegram")
-    token = models.CharField(max_length=200, blank=True)  # Telegram bot token
+    # Telegram bot token
+    token = models.CharField(max_length=200, blank=True, db_index=True)
     webhook_url = models.CharField(max_length=200, blank=True)
     is_active = models.BooleanField(default=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -40,6 +41,8 @@ class Scenario(models.Model):
     )
     is_active = models.BooleanField(default=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Bumped on every change of the scenario or its steps (see signals.py)
+    version = models.PositiveIntegerField(default=1, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -49,6 +52,15 @@ class Scenario(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        updating = not self._state.adding
+        if updating:
+            # Never write back a stale in-memory version, only move it forward
+            self.version = models.F("version") + 1
+        super().save(*args, **kwargs)
+        if updating:
+            self.refresh_from_db(fields=["version"])
+
 
 class Step(models.Model):
     STEP_TYPES = [
@@ -91,6 +103,15 @@ class BotSettings(models.Model):
     max_tokens = models.IntegerField(default=500)
     temperature = models.FloatField(default=0.7)
     max_requests_per_minute = models.IntegerField(default=60)
+    # Show Mistral answers progressively while they are generated
+    stream_responses = models.BooleanField(default=False)
+    # Reuse answers to identical prompts for cache_ttl seconds
+    cache_responses = models.BooleanField(default=False)
+    cache_ttl = models.PositiveIntegerField(default=3600)
+    # Estimated prompt tokens for system prompt, summary and history
+    context_token_budget = models.PositiveIntegerField(default=2000)
+    # Move older messages to the on-disk archive, 0 keeps them all in the table
+    archive_after_days = models.PositiveIntegerField(default=90)
 
     class Meta:
         db_table = "bot_settings"
@@ -122,17 +143,78 @@ class Conversation(models.Model):
 
 
 class Message(models.Model):
+    """One exchange: the user's message and the bot's answer to it"""
+
     conversation = models.ForeignKey(
         Conversation, on_delete=models.CASCADE, related_name="messages"
     )
     step = models.ForeignKey(Step, on_delete=models.SET_NULL, null=True, blank=True)
     user_message = models.TextField(blank=True)
     bot_message = models.TextField(blank=True)
+    # Time to answer and Mistral token usage, empty when unknown
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = "messages"
         ordering = ["timestamp"]
+        indexes = [models.Index(fields=["conversation", "timestamp"])]
 
     def __str__(self):
         return f"Message at {self.timestamp}"
+
+
+class BroadcastJob(models.Model):
+    """One text sent to every active conversation of a bot
+
+    Conversations are sent to in id order; last_conversation_id is the
+    checkpoint up to which all of them are done, the run_broadcasts
+    command resumes after it.
+    """
+
+    STATUSES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("completed", "Completed"),
+        ("cancelled", "Cancelled"),
+    ]
+
+    bot = models.ForeignKey(Bot, on_delete=models.CASCADE, related_name="broadcasts")
+    text = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUSES, default="pending")
+    # Active conversations when the job was created
+    total = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    last_conversation_id = models.PositiveBigIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "broadcast_jobs"
+
+    def __str__(self):
+        return f"Broadcast {self.pk} of {self.bot.name}"
+
+    @property
+    def throughput(self):
+        """Messages per second since the job started"""
+        if not self.started_at:
+            return 0.0
+        end = self.finished_at or self.updated_at
+        elapsed = (end - self.started_at).total_seconds()
+        return round((self.sent + self.failed) / elapsed, 2) if elapsed > 0 else 0.0
+
+    @property
+    def eta_seconds(self):
+        """Seconds left at the current throughput, None when unknown"""
+        if self.status == "completed":
+            return 0
+        if not self.throughput:
+            return None
+        remaining = max(0, self.total - self.sent - self.failed)
+        return round(remaining / self.throughput)
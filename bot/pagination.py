@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ConversationCursorPagination(CursorPagination):
+    """Keyset pages of conversations, newest first"""
+
+    ordering = "-id"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+
+class MessageCursorPagination(CursorPagination):
+    """Keyset pages of a conversation's messages, oldest first"""
+
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .dedup import get_update_dedup
+from .local_store import LocalStore, store_path
+from .registry import registry
+from .update_queue import chat_key, get_update_queue
+
+logger = logging.getLogger(__name__)
+
+
+class PollingOffsets(LocalStore):
+    """Next getUpdates offset of every polled bot, kept across restarts"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS offsets (
+        bot_id INTEGER PRIMARY KEY,
+        token_hash TEXT NOT NULL,
+        next_offset INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    """
+
+    def get(self, bot_id, token):
+        """Stored offset, 0 when the bot got a new token since"""
+        row = self.connection.execute(
+            "SELECT token_hash, next_offset FROM offsets WHERE bot_id = ?", (bot_id,)
+        ).fetchone()
+        if row is None or row[0] != self._hash(token):
+            return 0
+        return row[1]
+
+    def set(self, bot_id, token, next_offset):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO offsets "
+            "(bot_id, token_hash, next_offset, updated_at) VALUES (?, ?, ?, ?)",
+            (bot_id, self._hash(token), next_offset, time.time()),
+        )
+
+    def _hash(self, token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def dispatch_update(bot_token, update_data):
+    """Feed an update into the pipeline the webhook uses
+
+    In queue mode the update goes to the update queue, returns False when
+    the queue is full. Otherwise it is handled by the async pipeline.
+    Updates handled before are skipped.
+    """
+    dedup = get_update_dedup()
+    if not await sync_to_async(dedup.claim)(bot_token, update_data):
+        return True
+
+    try:
+        if settings.BOT_INGESTION_MODE == "queue":
+            accepted = await sync_to_async(get_update_queue().put)(
+                bot_token, json.dumps(update_data)
+            )
+        else:
+            bundle = await registry.aget(bot_token)
+            if bundle is not None:
+                await bundle.handler.ahandle_update(update_data)
+            accepted = True
+    except BaseException:
+        # Обновление будет получено снова, повтор не должен отброситься
+        await sync_to_async(dedup.release)(bot_token, update_data)
+        raise
+
+    if not accepted:
+        await sync_to_async(dedup.release)(bot_token, update_data)
+    return accepted
+
+
+class BotPoller:
+    """Long-polls getUpdates for one bot until cancelled
+
+    Updates of one chat are handled in order, different chats of a batch
+    concurrently. The offset is stored after the batch is handled, so an
+    update is never lost, but may be handled twice after a crash.
+    """
+
+    max_backoff = 60
+
+    def __init__(self, bot_id, token, client, offsets):
+        self.bot_id = bot_id
+        self.token = token
+        self.client = client
+        self.offsets = offsets
+
+    async def run(self, delete_webhook=False):
+        offset = await sync_to_async(self.offsets.get)(self.bot_id, self.token)
+        backoff = 1
+        while True:
+            try:
+                if delete_webhook:
+                    await self.client.post(self._method_url("deleteWebhook"))
+                    delete_webhook = False
+                updates = await self._get_updates(offset)
+                if updates:
+                    offset = await self._handle(updates)
+                backoff = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Polling bot {self.bot_id} failed: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    async def _get_updates(self, offset):
+        response = await self.client.post(
+            self._method_url("getUpdates"),
+            json={"offset": offset, "timeout": settings.BOT_POLLING_TIMEOUT},
+        )
+        body = response.json()
+        if not body.get("ok"):
+            # 409 - у бота установлен вебхук, 401 - неверный токен
+            raise RuntimeError(
+                f"getUpdates: {body.get('error_code')} {body.get('description')}"
+            )
+        return body["result"]
+
+    def _method_url(self, method):
+        return f"{settings.TELEGRAM_API_URL}/bot{self.token}/{method}"
+
+    async def _handle(self, updates):
+        chats = {}
+        for update in updates:
+            chats.setdefault(chat_key(self.token, update), []).append(update)
+        await asyncio.gather(*(self._handle_chat(batch) for batch in chats.values()))
+
+        next_offset = updates[-1]["update_id"] + 1
+        await sync_to_async(self.offsets.set)(self.bot_id, self.token, next_offset)
+        return next_offset
+
+    async def _handle_chat(self, updates):
+        for update in updates:
+            while not await dispatch_update(self.token, update):
+                # Очередь переполнена: ждем, пока воркеры ее разберут
+                await asyncio.sleep(5)
+
+
+class PollingSupervisor:
+    """Runs a BotPoller for every active Telegram bot in one event loop
+
+    The bot list is re-read every BOT_POLLING_REFRESH seconds: pollers of
+    new bots are started, those of removed, deactivated or re-tokened bots
+    are cancelled.
+    """
+
+    def __init__(self, delete_webhooks=False):
+        self.offsets = PollingOffsets(store_path(settings.BOT_POLLING_OFFSETS_FILE))
+        self.delete_webhooks = delete_webhooks
+        self.tasks = {}
+
+    async def run(self, stop):
+        timeout = settings.BOT_POLLING_TIMEOUT
+        async with httpx.AsyncClient(
+            # Long poll plus a margin for the network
+            timeout=httpx.Timeout(timeout + 10, connect=10),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+        ) as client:
+            while not stop.is_set():
+                try:
+                    await self.refresh(client)
+                except Exception as e:
+                    logger.error(f"Failed to refresh the polled bots: {e}")
+                try:
+                    await asyncio.wait_for(
+                        stop.wait(), timeout=settings.BOT_POLLING_REFRESH
+                    )
+                except TimeoutError:
+                    pass
+
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def refresh(self, client):
+        bots = await sync_to_async(self._active_bots)()
+        for key in set(self.tasks) - set(bots):
+            self.tasks.pop(key).cancel()
+            logger.info(f"Stopped polling bot {key[0]}")
+        for key in set(bots) - set(self.tasks):
+            bot_id, token = key
+            poller = BotPoller(bot_id, token, client, self.offsets)
+            self.tasks[key] = asyncio.create_task(poller.run(self.delete_webhooks))
+            logger.info(f"Started polling bot {bot_id}")
+
+    def _active_bots(self):
+        from .models import Bot
+
+        rows = (
+            Bot.objects.filter(is_active=True, bot_type="telegram")
+            .exclude(token="")
+            .values_list("id", "token")
+        )
+        return set(rows)
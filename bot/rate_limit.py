@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .local_store import LocalStore, store_path
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class TokenBucketLimiter(LocalStore):
+    """Token buckets shared by all worker processes through a SQLite file
+
+    A caller that finds the bucket empty reserves the next free token and
+    sleeps until it is due, so waiting requests are served in arrival order.
+    Requests that would wait longer than max_wait are rejected instead.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS limiter_stats (
+        key TEXT PRIMARY KEY,
+        acquired INTEGER NOT NULL DEFAULT 0,
+        delayed INTEGER NOT NULL DEFAULT 0,
+        wait_seconds REAL NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0
+    );
+    """
+
+    def reserve(self, key, rate_per_minute, max_wait, burst=None):
+        """Take one token, return seconds to wait before using it
+
+        The bucket holds burst tokens, a full minute of them by default.
+        """
+        now = time.time()
+        capacity = float(burst or rate_per_minute)
+        refill = rate_per_minute / 60.0
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = capacity
+            if row:
+                tokens = min(capacity, row[0] + (now - row[1]) * refill)
+
+            # Отрицательный остаток - токены, уже обещанные ожидающим
+            wait = max(0.0, (1 - tokens) / refill)
+            rejected = wait > max_wait
+            if rejected:
+                self._record(conn, key, rejected=1)
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) "
+                    "VALUES (?, ?, ?)",
+                    (key, tokens - 1, now),
+                )
+                self._record(
+                    conn, key, acquired=1, delayed=int(wait > 0), wait_seconds=wait
+                )
+
+        if rejected:
+            logger.warning(f"Rate limit for {key} exceeded, wait would be {wait:.1f}s")
+            raise RateLimitExceeded(f"{key} would wait {wait:.1f}s")
+        return wait
+
+    def acquire(self, key, rate_per_minute, max_wait, burst=None):
+        """Block until a token for key is available"""
+        wait = self.reserve(key, rate_per_minute, max_wait, burst)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, key, rate_per_minute, max_wait, burst=None):
+        """Wait for a token for key without blocking the event loop"""
+        # BEGIN IMMEDIATE может ждать блокировку файла, поэтому в потоке
+        wait = await asyncio.to_thread(
+            self.reserve, key, rate_per_minute, max_wait, burst
+        )
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self, key):
+        row = self.connection.execute(
+            "SELECT acquired, delayed, wait_seconds, rejected "
+            "FROM limiter_stats WHERE key = ?",
+            (key,),
+        ).fetchone()
+        acquired, delayed, wait_seconds, rejected = row or (0, 0, 0.0, 0)
+        return {
+            "acquired": acquired,
+            "delayed": delayed,
+            "rejected": rejected,
+            "total_wait_seconds": round(wait_seconds, 3),
+            "avg_wait_seconds": round(wait_seconds / delayed, 3) if delayed else 0.0,
+        }
+
+    def _record(self, conn, key, acquired=0, delayed=0, wait_seconds=0.0, rejected=0):
+        conn.execute(
+            "INSERT INTO limiter_stats "
+            "(key, acquired, delayed, wait_seconds, rejected) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "acquired = acquired + excluded.acquired, "
+            "delayed = delayed + excluded.delayed, "
+            "wait_seconds = wait_seconds + excluded.wait_seconds, "
+            "rejected = rejected + excluded.rejected",
+            (key, acquired, delayed, wait_seconds, rejected),
+        )
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Process-wide TokenBucketLimiter configured from settings"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = TokenBucketLimiter(
+                    store_path(settings.MISTRAL_RATE_LIMIT_FILE)
+                )
+    return _limiter
+
+
+def bot_quota_key(bot):
+    return f"mistral:bot:{bot.pk}"
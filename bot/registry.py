@@ -0,0 +1,96 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+@dataclass
+class BotBundle:
+    """Everything needed to handle an update of one bot, built once"""
+
+    bot: object
+    handler: object
+    graph: object
+    loaded_at: float
+
+
+class BotRegistry:
+    """Warm map of webhook tokens to prepared bot bundles
+
+    Signals drop bundles changed in this process, BOT_REGISTRY_TTL bounds
+    how long changes made by other processes stay unnoticed.
+    """
+
+    def __init__(self):
+        self._bundles = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Bundle of the active bot with this token, or None"""
+        bundle = self._bundles.get(token)
+        if bundle is not None and not self._expired(bundle):
+            return bundle
+        return self._load(token)
+
+    async def aget(self, token):
+        bundle = self._bundles.get(token)
+        if bundle is not None and not self._expired(bundle):
+            return bundle
+        return await sync_to_async(self._load)(token)
+
+    def warm(self):
+        """Load bundles of all active bots up front"""
+        from .models import Bot
+
+        tokens = Bot.objects.filter(is_active=True).exclude(token="")
+        for token in tokens.values_list("token", flat=True):
+            self._load(token)
+
+    def invalidate_bot(self, bot_id):
+        with self._lock:
+            for token, bundle in list(self._bundles.items()):
+                if bundle.bot.pk == bot_id:
+                    del self._bundles[token]
+
+    def invalidate_scenario(self, scenario_id):
+        with self._lock:
+            for token, bundle in list(self._bundles.items()):
+                if bundle.bot.scenario_id == scenario_id:
+                    del self._bundles[token]
+
+    def clear(self):
+        with self._lock:
+            self._bundles.clear()
+
+    def _expired(self, bundle):
+        return time.monotonic() - bundle.loaded_at > settings.BOT_REGISTRY_TTL
+
+    def _load(self, token):
+        from .models import Bot
+        from .scenario_graph import get_scenario_graph
+        from .telegram_handler import TelegramBotHandler
+
+        bot = (
+            Bot.objects.select_related("settings", "scenario")
+            .filter(token=token, is_active=True)
+            .first()
+        )
+        if bot is None:
+            with self._lock:
+                self._bundles.pop(token, None)
+            return None
+
+        bundle = BotBundle(
+            bot=bot,
+            handler=TelegramBotHandler(bot),
+            graph=get_scenario_graph(bot.scenario) if bot.scenario else None,
+            loaded_at=time.monotonic(),
+        )
+        with self._lock:
+            self._bundles[token] = bundle
+        return bundle
+
+
+registry = BotRegistry()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .local_store import LocalStore, store_path
+
+
+def cache_key(model, temperature, max_tokens, messages):
+    """Stable key of a completion request, insensitive to whitespace noise"""
+    normalized = [
+        [message["role"], " ".join(message["content"].split())] for message in messages
+    ]
+    raw = json.dumps(
+        [model, temperature, max_tokens, normalized],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class PersistentResponseStore(LocalStore):
+    schema = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        if row[1] <= time.time():
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None, None
+        return row
+
+    def set(self, key, value, expires_at):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, expires_at) "
+            "VALUES (?, ?, ?)",
+            (key, value, expires_at),
+        )
+
+    def purge(self):
+        self.connection.execute(
+            "DELETE FROM responses WHERE expires_at <= ?", (time.time(),)
+        )
+
+
+class ResponseCache:
+    """Two-tier TTL cache of Mistral completions
+
+    The memory tier is an LRU bounded by the total size of stored answers,
+    the optional persistent tier survives restarts and is shared by all
+    processes on the host.
+    """
+
+    purge_every = 1000
+
+    def __init__(self, max_bytes, persistent=None):
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._stats = {
+            "memory_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry[1]
+                self._remove(key)
+
+        if self.persistent is not None:
+            value, expires_at = self.persistent.get(key)
+            if value is not None:
+                with self._lock:
+                    self._stats["persistent_hits"] += 1
+                    self._put(key, value, expires_at)
+                return value
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._stats["stores"] += 1
+            self._put(key, value, expires_at)
+            self._sets += 1
+            purge = self._sets % self.purge_every == 0
+
+        if self.persistent is not None:
+            self.persistent.set(key, value, expires_at)
+            if purge:
+                self.persistent.purge()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._size
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_ratio"] = (
+            round((lookups - stats["misses"]) / lookups, 3) if lookups else 0.0
+        )
+        return stats
+
+    def _put(self, key, value, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(value.encode())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, value, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)[2]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide ResponseCache configured from settings"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                persistent = None
+                if settings.MISTRAL_CACHE_PERSISTENT:
+                    persistent = PersistentResponseStore(
+                        store_path(settings.MISTRAL_CACHE_FILE)
+                    )
+                _cache = ResponseCache(settings.MISTRAL_CACHE_MAX_BYTES, persistent)
+    return _cache
@@ -0,0 +1,97 @@
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+
+from asgiref.sync import sync_to_async
+
+
+@dataclass(frozen=True)
+class CompiledStep:
+    id: int
+    name: str
+    step_type: str
+    content: str
+    order: int
+    next_step_id: int
+    metadata: MappingProxyType
+
+
+@dataclass(frozen=True)
+class ScenarioGraph:
+    """Immutable snapshot of a scenario, safe to share between threads"""
+
+    scenario_id: int
+    version: int
+    initial_step_id: int
+    steps: MappingProxyType
+    ordered_steps: tuple
+
+    def step(self, step_id):
+        return self.steps.get(step_id) if step_id else None
+
+    def next_step(self, step):
+        return self.step(step.next_step_id)
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def compile_scenario(scenario_id):
+    """Load scenario and its steps into a ScenarioGraph (two queries)"""
+    from .models import Scenario, Step
+
+    # Версию читаем раньше шагов: граф может оказаться новее своей версии,
+    # но никогда не старше, поэтому изменение не потеряется
+    scenario = Scenario.objects.only("id", "version", "initial_step_id").get(
+        pk=scenario_id
+    )
+    ordered_steps = tuple(
+        CompiledStep(
+            id=step.id,
+            name=step.name,
+            step_type=step.step_type,
+            content=step.content,
+            order=step.order,
+            next_step_id=step.next_step_id,
+            metadata=MappingProxyType(dict(step.metadata or {})),
+        )
+        for step in Step.objects.filter(scenario_id=scenario_id).order_by("order")
+    )
+    return ScenarioGraph(
+        scenario_id=scenario.id,
+        version=scenario.version,
+        initial_step_id=scenario.initial_step_id,
+        steps=MappingProxyType({step.id: step for step in ordered_steps}),
+        ordered_steps=ordered_steps,
+    )
+
+
+def get_scenario_graph(scenario):
+    """Compiled graph for a loaded Scenario, without queries when cached
+
+    Signals drop graphs changed in this process; changes made by other
+    processes are noticed once the caller loads a newer scenario.version.
+    """
+    graph = _graphs.get(scenario.pk)
+    if graph is not None and graph.version >= scenario.version:
+        return graph
+
+    graph = compile_scenario(scenario.pk)
+    with _graphs_lock:
+        current = _graphs.get(scenario.pk)
+        if current is None or current.version <= graph.version:
+            _graphs[scenario.pk] = graph
+    return graph
+
+
+async def aget_scenario_graph(scenario):
+    graph = _graphs.get(scenario.pk)
+    if graph is not None and graph.version >= scenario.version:
+        return graph
+    return await sync_to_async(get_scenario_graph)(scenario)
+
+
+def invalidate_scenario(scenario_id):
+    with _graphs_lock:
+        _graphs.pop(scenario_id, None)
@@ -1,5 +1,19 @@
+from collections import Counter
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
-from .models import Bot, Scenario, Step, BotSettings, Conversation, Message
+from .models import (
+    Bot,
+    Scenario,
+    Step,
+    BotSettings,
+    Conversation,
+    Message,
+    BroadcastJob,
+)
 
 
 class StepSerializer(serializers.ModelSerializer):
@@ -16,26 +30,148 @@ class ScenarioSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+def scenario_payload_key(scenario):
+    # Step changes bump the version (see signals.py), so stale payloads
+    # are never read again and simply expire
+    return (
+        f"bot:scenario-payload:{scenario.pk}:{scenario.version}:"
+        f"{scenario.updated_at.timestamp()}"
+    )
+
+
+def scenario_payloads(scenarios):
+    """ScenarioSerializer data by scenario id, from the cache when possible
+
+    Steps of all scenarios missing from the cache are loaded in one query.
+    """
+    scenarios = {scenario.pk: scenario for scenario in scenarios}
+    keys = {scenario_payload_key(s): pk for pk, s in scenarios.items()}
+    payloads = {keys[key]: data for key, data in cache.get_many(keys).items()}
+
+    missing = [s for pk, s in scenarios.items() if pk not in payloads]
+    if missing:
+        prefetch_related_objects(missing, "steps")
+        fresh = {
+            scenario_payload_key(s): dict(ScenarioSerializer(s).data) for s in missing
+        }
+        cache.set_many(fresh, django_settings.BOT_PAYLOAD_CACHE_TTL)
+        payloads.update((keys[key], data) for key, data in fresh.items())
+    return payloads
+
+
+class ExpandableFieldsMixin:
+    """Let clients trim the representation with query parameters
+
+    ?fields=id,name keeps only the listed fields; ?expand=settings keeps
+    only the listed nested fields out of Meta.expandable_fields, an empty
+    ?expand= drops them all. Without the parameters everything is returned.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return fields
+
+        params = request.query_params
+        if "fields" in params:
+            wanted = set(filter(None, params["fields"].split(",")))
+            for name in set(fields) - wanted:
+                fields.pop(name)
+        if "expand" in params:
+            wanted = set(filter(None, params["expand"].split(",")))
+            for name in set(self.Meta.expandable_fields) - wanted:
+                fields.pop(name, None)
+        return fields
+
+
 class BotSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = BotSettings
         fields = "__all__"
 
 
-class BotSerializer(serializers.ModelSerializer):
+class BotListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        bots = list(data.all() if hasattr(data, "all") else data)
+        if "scenario_details" in self.child.fields:
+            # One cache round trip for the scenarios of the whole list
+            self.child.scenario_payloads = scenario_payloads(
+                bot.scenario for bot in bots if bot.scenario_id
+            )
+        return super().to_representation(bots)
+
+
+class BotSerializer(ExpandableFieldsMixin, serializers.ModelSerializer):
     settings = BotSettingsSerializer(read_only=True)
-    scenario_details = ScenarioSerializer(source="scenario", read_only=True)
+    scenario_details = serializers.SerializerMethodField()
 
     class Meta:
         model = Bot
         fields = "__all__"
         read_only_fields = ("owner", "created_at", "updated_at")
+        expandable_fields = ("settings", "scenario_details")
+        list_serializer_class = BotListSerializer
+
+    def get_scenario_details(self, bot):
+        if not bot.scenario_id:
+            return None
+        payloads = getattr(self, "scenario_payloads", None)
+        if payloads is None:
+            payloads = scenario_payloads([bot.scenario])
+        return payloads[bot.scenario_id]
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    # Each row is a whole exchange, both texts are filled
     class Meta:
         model = Message
         fields = "__all__"
+        read_only_fields = ("latency_ms", "prompt_tokens", "completion_tokens")
+
+
+class BroadcastJobSerializer(serializers.ModelSerializer):
+    throughput = serializers.FloatField(read_only=True)
+    eta_seconds = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = BroadcastJob
+        fields = "__all__"
+        read_only_fields = (
+            "bot",
+            "status",
+            "total",
+            "sent",
+            "failed",
+            "last_conversation_id",
+            "started_at",
+            "finished_at",
+        )
+
+
+# Read-only fast path: rows of .values(*fields) render as they are and
+# match the serializers above field for field
+CONVERSATION_LIST_FIELDS = (
+    "id",
+    "bot",
+    "user_identifier",
+    "current_step",
+    "is_active",
+    "context_data",
+    "created_at",
+    "updated_at",
+)
+MESSAGE_LIST_FIELDS = (
+    "id",
+    "conversation",
+    "step",
+    "user_message",
+    "bot_message",
+    "latency_ms",
+    "prompt_tokens",
+    "completion_tokens",
+    "timestamp",
+)
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -50,3 +186,136 @@ class StepCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Step
         fields = "__all__"
+
+
+class GraphStepSerializer(serializers.ModelSerializer):
+    """Step of a scenario document, linked by symbolic refs instead of ids"""
+
+    ref = serializers.CharField(max_length=100)
+    next_step = serializers.CharField(
+        max_length=100, allow_null=True, required=False, default=None
+    )
+
+    class Meta:
+        model = Step
+        fields = (
+            "ref",
+            "name",
+            "step_type",
+            "content",
+            "order",
+            "next_step",
+            "metadata",
+        )
+
+
+class ScenarioGraphSerializer(serializers.ModelSerializer):
+    """Whole scenario with its steps as one JSON document
+
+    Steps refer to each other, and the scenario to its initial step, by
+    the ref of a step in the same document. The import runs in a single
+    transaction with a fixed number of queries whatever the step count.
+    """
+
+    initial_step = serializers.CharField(
+        max_length=100, allow_null=True, required=False, default=None
+    )
+    steps = GraphStepSerializer(many=True)
+
+    class Meta:
+        model = Scenario
+        fields = ("name", "description", "is_active", "initial_step", "steps")
+
+    def validate(self, attrs):
+        refs = [step["ref"] for step in attrs["steps"]]
+        duplicates = sorted(ref for ref, n in Counter(refs).items() if n > 1)
+        if duplicates:
+            raise serializers.ValidationError(
+                {"steps": f"Duplicate step refs: {', '.join(duplicates)}"}
+            )
+
+        known = set(refs)
+        unknown = sorted(
+            {step["next_step"] for step in attrs["steps"]} - known - {None}
+        )
+        if unknown:
+            raise serializers.ValidationError(
+                {"steps": f"Unknown next_step refs: {', '.join(unknown)}"}
+            )
+        if attrs["initial_step"] is not None and attrs["initial_step"] not in known:
+            raise serializers.ValidationError(
+                {"initial_step": f"Unknown step ref: {attrs['initial_step']}"}
+            )
+        return attrs
+
+    def create(self, validated_data):
+        steps_data = validated_data.pop("steps")
+        initial_ref = validated_data.pop("initial_step")
+
+        with transaction.atomic():
+            scenario = Scenario.objects.create(**validated_data)
+            # bulk_create skips the per-step signals, the final save
+            # below bumps the scenario version once
+            steps = Step.objects.bulk_create(
+                [
+                    Step(
+                        scenario=scenario,
+                        **{
+                            key: value
+                            for key, value in data.items()
+                            if key not in ("ref", "next_step")
+                        },
+                    )
+                    for data in steps_data
+                ]
+            )
+            by_ref = {data["ref"]: step for data, step in zip(steps_data, steps)}
+
+            linked = []
+            for data, step in zip(steps_data, steps):
+                if data["next_step"] is not None:
+                    step.next_step = by_ref[data["next_step"]]
+                    linked.append(step)
+            Step.objects.bulk_update(linked, ["next_step"], batch_size=500)
+
+            if initial_ref is not None:
+                scenario.initial_step = by_ref[initial_ref]
+            scenario.save()
+        return scenario
+
+    def to_representation(self, scenario):
+        steps = list(scenario.steps.all())
+        refs = _step_refs(steps)
+        return {
+            "name": scenario.name,
+            "description": scenario.description,
+            "is_active": scenario.is_active,
+            "initial_step": refs.get(scenario.initial_step_id),
+            "steps": [
+                {
+                    "ref": refs[step.id],
+                    "name": step.name,
+                    "step_type": step.step_type,
+                    "content": step.content,
+                    "order": step.order,
+                    "next_step": refs.get(step.next_step_id),
+                    "metadata": step.metadata,
+                }
+                for step in steps
+            ],
+        }
+
+
+def _step_refs(steps):
+    """Readable refs for exported steps: their names, made unique"""
+    refs = {}
+    used = set()
+    for step in steps:
+        ref = step.name
+        suffix = 2
+        while ref in used:
+            ref = f"{step.name}-{suffix}"
+            suffix += 1
+        used.add(ref)
+        refs[step.id] = ref
+    return refs
@@ -1,7 +1,75 @@
-
 # from mistralai import MistralClient
-from .mistral_client import MistralAPIClient
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .context import fit_history, fold_summary, history_messages, message_tokens
+from .history import (
+    UNCHECKED,
+    aevicted_history,
+    append_history,
+    arecent_history,
+    evicted_history,
+    last_message_id,
+    recent_history,
+)
+from .mistral_client import FALLBACK_RESPONSE, MistralAPIClient
 from .models import Conversation, Message
+from .rate_limit import RateLimitExceeded, bot_quota_key, get_rate_limiter
+from .response_cache import cache_key, get_response_cache
+from .scenario_graph import aget_scenario_graph, get_scenario_graph
+from .single_flight import get_single_flight
+
+# Marks an exchange that leaves the conversation at its current step
+KEEP = object()
+
+BUSY_RESPONSE = "I'm getting too many requests right now, please try again in a minute."
+
+# Starts the system message that carries the rolling summary
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+
+class StreamInterrupted(Exception):
+    """A streamed answer broke off, text is the part already shown"""
+
+    def __init__(self, text):
+        super().__init__("Mistral stream interrupted")
+        self.text = text
+
+
+class SystemPromptCache:
+    """System prompts built once per scenario version"""
+
+    def __init__(self):
+        self._prompts = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "builds": 0}
+
+    def get(self, graph, build):
+        """Prompt for graph, calling build(ordered_steps) on a new version"""
+        entry = self._prompts.get(graph.scenario_id)
+        if entry is not None and entry[0] == graph.version:
+            with self._lock:
+                self._stats["hits"] += 1
+            return entry[1]
+
+        prompt = build(graph.ordered_steps)
+        with self._lock:
+            self._stats["builds"] += 1
+            current = self._prompts.get(graph.scenario_id)
+            if current is None or current[0] <= graph.version:
+                self._prompts[graph.scenario_id] = (graph.version, prompt)
+        return prompt
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, scenarios=len(self._prompts))
+
+
+system_prompts = SystemPromptCache()
 
 
 class MistralService:
@@ -10,62 +78,345 @@ class MistralService:
         self.settings = bot.settings
         self.client = MistralAPIClient(api_key=self.settings.mistral_api_key)
 
-    def generate_response(self, user_message, conversation_context=None):
-        """Generate response using Mistral API"""
+    def generate_response(
+        self, user_message, conversation_context=None, on_delta=None, usage=None
+    ):
+        """Generate response using Mistral API
+
+        When the bot streams responses, on_delta is called with the text
+        generated so far every time a new chunk arrives. A stream that
+        breaks off returns the part already shown, it is never cached.
+        Token usage of the API call, if any was made, is copied into the
+        usage dict.
+
+        Concurrent calls with the same request share one API call, the
+        callers that joined it get the answer only when it is complete.
+        """
         try:
             messages = self._prepare_messages(user_message, conversation_context)
+            key = self._request_key(messages)
+            cached = self._cache_lookup(key)
+            if cached is not None:
+                if on_delta:
+                    on_delta(cached)
+                return cached
+
+            response = get_single_flight().do(
+                self._flight_key(key), lambda: self._complete(messages, on_delta, usage)
+            )
+
+            self._cache_store(key, response)
+            return response
+        except StreamInterrupted as e:
+            # Неполный ответ не кэшируется и не раздается другим запросам
+            return e.text
+        except RateLimitExceeded as e:
+            print(f"Mistral quota exhausted: {e}")
+            return BUSY_RESPONSE
+        except Exception as e:
+            print(f"Mistral API error: {e}")
+            return FALLBACK_RESPONSE
 
-            response = self.client.chat_completion(
-                model=self.settings.mistral_model,
-                messages=messages,
-                max_tokens=self.settings.max_tokens,
-                temperature=self.settings.temperature,
+    async def agenerate_response(
+        self, user_message, conversation_context=None, on_delta=None, usage=None
+    ):
+        """Generate response using Mistral API from a coroutine
+
+        on_delta is a coroutine function, see generate_response.
+        """
+        try:
+            messages = await self._aprepare_messages(user_message, conversation_context)
+            key = self._request_key(messages)
+            cached = self._cache_lookup(key)
+            if cached is not None:
+                if on_delta:
+                    await on_delta(cached)
+                return cached
+
+            response = await get_single_flight().ado(
+                self._flight_key(key),
+                lambda: self._acomplete(messages, on_delta, usage),
             )
 
+            self._cache_store(key, response)
             return response
+        except StreamInterrupted as e:
+            return e.text
+        except RateLimitExceeded as e:
+            print(f"Mistral quota exhausted: {e}")
+            return BUSY_RESPONSE
         except Exception as e:
             print(f"Mistral API error: {e}")
-            return "I'm sorry, I'm having trouble processing your request right now."
+            return FALLBACK_RESPONSE
+
+    def _request_key(self, messages):
+        """Key of the normalized request, for the cache and single flight"""
+        return cache_key(
+            self.settings.mistral_model,
+            self.settings.temperature,
+            self.settings.max_tokens,
+            messages,
+        )
+
+    def _flight_key(self, key):
+        """Single flight key, shared only by requests of the same bot
+
+        Joined callers are served with the leader's API key and quota.
+        """
+        return f"{self.bot.pk}:{key}"
+
+    def _cache_lookup(self, key):
+        """Return cached answer for bots that opted in"""
+        if not self.settings.cache_responses:
+            return None
+        return get_response_cache().get(key)
+
+    def _cache_store(self, key, response):
+        # Ответ-заглушку после ошибки API не кэшируем
+        if self.settings.cache_responses and response != FALLBACK_RESPONSE:
+            get_response_cache().set(key, response, self.settings.cache_ttl)
+
+    def _complete(self, messages, on_delta, usage):
+        """One API call within the bot's quota"""
+        self._acquire_quota()
+        if on_delta and self.settings.stream_responses:
+            return self._stream_response(messages, on_delta, usage)
+        return self.client.chat_completion(
+            model=self.settings.mistral_model,
+            messages=messages,
+            max_tokens=self.settings.max_tokens,
+            temperature=self.settings.temperature,
+            usage=usage,
+        )
+
+    async def _acomplete(self, messages, on_delta, usage):
+        await self._aacquire_quota()
+        if on_delta and self.settings.stream_responses:
+            return await self._astream_response(messages, on_delta, usage)
+        return await self.client.achat_completion(
+            model=self.settings.mistral_model,
+            messages=messages,
+            max_tokens=self.settings.max_tokens,
+            temperature=self.settings.temperature,
+            usage=usage,
+        )
+
+    def _acquire_quota(self):
+        """Wait for the bot's max_requests_per_minute budget"""
+        rate = self.settings.max_requests_per_minute
+        if rate > 0:
+            get_rate_limiter().acquire(
+                bot_quota_key(self.bot), rate, settings.MISTRAL_RATE_LIMIT_MAX_WAIT
+            )
+
+    async def _aacquire_quota(self):
+        rate = self.settings.max_requests_per_minute
+        if rate > 0:
+            await get_rate_limiter().aacquire(
+                bot_quota_key(self.bot), rate, settings.MISTRAL_RATE_LIMIT_MAX_WAIT
+            )
+
+    def _stream_response(self, messages, on_delta, usage=None):
+        text = ""
+        chunks = self.client.stream_chat_completion(
+            model=self.settings.mistral_model,
+            messages=messages,
+            max_tokens=self.settings.max_tokens,
+            temperature=self.settings.temperature,
+            usage=usage,
+        )
+        while True:
+            # Только чтение потока считается обрывом ответа Mistral
+            try:
+                chunk = next(chunks, None)
+            except Exception as e:
+                print(f"Mistral stream interrupted: {e}")
+                if text:
+                    # Показанную часть отдаём пользователю, но как неполный ответ
+                    raise StreamInterrupted(text) from e
+                break
+            if chunk is None:
+                break
+            text += chunk
+            on_delta(text)
+        return text or FALLBACK_RESPONSE
+
+    async def _astream_response(self, messages, on_delta, usage=None):
+        text = ""
+        chunks = self.client.astream_chat_completion(
+            model=self.settings.mistral_model,
+            messages=messages,
+            max_tokens=self.settings.max_tokens,
+            temperature=self.settings.temperature,
+            usage=usage,
+        )
+        while True:
+            try:
+                chunk = await anext(chunks, None)
+            except Exception as e:
+                print(f"Mistral stream interrupted: {e}")
+                if text:
+                    raise StreamInterrupted(text) from e
+                break
+            if chunk is None:
+                break
+            text += chunk
+            await on_delta(text)
+        return text or FALLBACK_RESPONSE
 
     def _prepare_messages(self, user_message, conversation_context):
         """Prepare message history for context"""
-        messages = []
-
-        # Add system prompt if available
+        system_prompt = None
         if hasattr(self.bot, "scenario") and self.bot.scenario:
             system_prompt = self._get_system_prompt()
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
 
-        # Add conversation history
+        history = []
         if conversation_context:
             # Get recent messages from conversation
-            recent_messages = Message.objects.filter(
-                conversation=conversation_context
-            ).order_by("-timestamp")[:10]  # Last 10 messages
+            history = recent_history(
+                conversation_context.pk,
+                getattr(conversation_context, "last_message_id", UNCHECKED),
+            )
+            gap = self._unsummarized_gap(history, conversation_context)
+            if gap:
+                history = evicted_history(conversation_context.pk, *gap) + history
+
+        return self._build_messages(
+            system_prompt, history, user_message, conversation_context
+        )
+
+    async def _aprepare_messages(self, user_message, conversation_context):
+        """Prepare message history for context using the async ORM"""
+        system_prompt = None
+        if self.bot.scenario:
+            graph = await aget_scenario_graph(self.bot.scenario)
+            system_prompt = system_prompts.get(graph, self._format_system_prompt)
+
+        history = []
+        if conversation_context:
+            history = await arecent_history(
+                conversation_context.pk,
+                getattr(conversation_context, "last_message_id", UNCHECKED),
+            )
+            gap = self._unsummarized_gap(history, conversation_context)
+            if gap:
+                evicted = await aevicted_history(conversation_context.pk, *gap)
+                history = evicted + history
+
+        return self._build_messages(
+            system_prompt, history, user_message, conversation_context
+        )
 
-            for msg in reversed(recent_messages):  # Oldest first
-                if msg.user_message:
-                    messages.append({"role": "user", "content": msg.user_message})
-                if msg.bot_message:
-                    messages.append({"role": "assistant", "content": msg.bot_message})
+    def _unsummarized_gap(self, history, conversation):
+        """(after_id, before_id) of rows that left the buffer unsummarized
+
+        Every row is folded into the summary on the turn before it leaves
+        the ring buffer, and the summary remembers the oldest row it has
+        not seen. A full buffer starting past that row lost some on the
+        way: a legacy summary, or turns stored by other processes.
+        """
+        if len(history) < settings.BOT_HISTORY_SIZE:
+            return None
+        summary = conversation.context_data.get("summary") or {}
+        through_id = summary.get("through_id", 0)
+        oldest = history[0][0]
+        if oldest <= through_id or summary.get("next_id") == oldest:
+            return None
+        return through_id, oldest
+
+    def _build_messages(self, system_prompt, history, user_message, conversation):
+        """Fit the prompt into the bot's context_token_budget
+
+        History is taken from the newest message back while it fits, older
+        messages are folded into a rolling summary kept in
+        conversation.context_data["summary"]. So are the rows that leave
+        the ring buffer with this exchange, however large the budget. Once
+        there is anything to summarize, a quarter of the budget is kept for
+        the summary before the history is fitted. A changed summary is
+        assigned as a new dict, the caller saves it together with the
+        exchange.
+        """
+        messages = []
+        current = {"role": "user", "content": user_message}
+
+        # Add system prompt if available
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+
+        summary = {}
+        if conversation is not None:
+            summary = conversation.context_data.get("summary") or {}
+
+        budget = self.settings.context_token_budget - sum(
+            message_tokens(m) for m in messages + [current]
+        )
+        # Ряды сверх размера буфера покидают его вместе с этим обменом
+        leaving = max(len(history) - (settings.BOT_HISTORY_SIZE - 1), 0)
+        dropped, kept = fit_history(history[leaving:], max(budget, 0))
+        summary_tokens = 0
+        if summary.get("text") or dropped or leaving:
+            # Сводке отводится постоянная доля бюджета, сколько бы она ни выросла
+            header = message_tokens({"content": SUMMARY_HEADER})
+            summary_tokens = max(
+                min(self.settings.context_token_budget // 4, budget - header), 0
+            )
+            dropped, kept = fit_history(
+                history[leaving:], max(budget - header - summary_tokens, 0)
+            )
+        dropped = history[:leaving] + dropped
+        summary_message = self._summary_message(
+            fold_summary(summary.get("text"), [], summary_tokens)
+        )
+
+        # Fold only messages the summary has not seen yet
+        through_id = summary.get("through_id", 0)
+        dropped = [entry for entry in dropped if entry[0] > through_id]
+        if dropped:
+            through_id = dropped[-1][0]
+            summary = {
+                "text": fold_summary(
+                    summary.get("text"),
+                    dropped,
+                    summary_tokens,
+                ),
+                "through_id": through_id,
+                "next_id": next(
+                    (entry[0] for entry in history if entry[0] > through_id), None
+                ),
+            }
+            conversation.context_data = dict(conversation.context_data, summary=summary)
+            summary_message = self._summary_message(summary["text"])
+
+        if summary_message:
+            messages.append(summary_message)
+
+        # Add conversation history, oldest first
+        messages.extend(history_messages(kept))
 
         # Add current user message
-        messages.append({"role": "user", "content": user_message})
+        messages.append(current)
 
         return messages
 
+    def _summary_message(self, text):
+        if not text:
+            return None
+        return {"role": "system", "content": SUMMARY_HEADER + text}
+
     def _get_system_prompt(self):
         """Generate system prompt from scenario steps"""
         if not self.bot.scenario:
             return "You are a helpful AI assistant."
 
+        graph = get_scenario_graph(self.bot.scenario)
+        return system_prompts.get(graph, self._format_system_prompt)
+
+    def _format_system_prompt(self, steps):
         # Build prompt from scenario steps
         prompt_parts = [
             "You are an AI assistant following a specific conversation flow."
         ]
 
-        steps = self.bot.scenario.steps.all().order_by("order")
         for step in steps:
             if step.step_type == "message":
                 prompt_parts.append(f"When at step '{step.name}': {step.content}")
@@ -76,83 +427,180 @@ class MistralService:
 
 
 class ScenarioProcessor:
-    def __init__(self, bot, user_identifier):
-        self.bot = bot
-        self.user_identifier = user_identifier
-        self.mistral_service = MistralService(bot)
+    """Runs one user message through the bot's scenario
 
-    def process_message(self, user_message):
-        """Process user message according to scenario"""
-        # Get or create conversation
-        conversation, created = Conversation.objects.get_or_create(
-            bot=self.bot,
-            user_identifier=self.user_identifier,
-            defaults={"is_active": True},
-        )
+    Query budget per message, with the bot and its compiled scenario graph
+    already loaded (see registry.py):
 
-        # If new conversation, start from initial step
-        if created and self.bot.scenario and self.bot.scenario.initial_step:
-            conversation.current_step = self.bot.scenario.initial_step
-            conversation.save()
+    * 1 SELECT of the conversation;
+    * 1 SELECT of the history, only when Mistral answers and the chat's
+      recent messages are not cached (see history.py);
+    * 1 transaction writing the exchange: INSERT of its Message row plus
+      an UPDATE of the conversation state, or INSERT of the conversation
+      instead of the UPDATE on the first message of a chat.
 
-        # Process based on current step
-        if conversation.current_step:
-            return self._process_with_scenario(conversation, user_message)
-        else:
-            return self._process_with_mistral(conversation, user_message)
+    The Mistral call happens before the write transaction, so no lock is
+    held while waiting for the API.
+    """
 
-    def _process_with_scenario(self, conversation, user_message):
-        """Process message according to scenario steps"""
-        current_step = conversation.current_step
+    def __init__(self, bot, user_identifier, mistral_service=None):
+        self.bot = bot
+        self.user_identifier = user_identifier
+        self.mistral_service = mistral_service or MistralService(bot)
 
-        # Save user message
-        Message.objects.create(
-            conversation=conversation, step=current_step, user_message=user_message
-        )
+    def process_message(self, user_message, on_delta=None):
+        """Process user message according to scenario
 
-        # Handle different step types
-        if current_step.step_type == "message":
-            response = current_step.content
-            next_step = current_step.next_step
+        on_delta receives partial Mistral answers, see
+        MistralService.generate_response.
+        """
+        started = time.monotonic()
+        graph = get_scenario_graph(self.bot.scenario) if self.bot.scenario else None
+        conversation = self._conversations().first()
+        conversation = self._start(conversation, graph)
+        summary = conversation.context_data.get("summary")
+        usage = {}
 
-        elif current_step.step_type == "question":
-            # Use Mistral to generate response based on user's answer
+        # Process based on current step
+        current_step = graph.step(conversation.current_step_id) if graph else None
+        if current_step:
+            response, next_step_id = self._resolve_step(current_step, graph)
+            if response is None:
+                # Use Mistral to generate response based on user's answer
+                response = self.mistral_service.generate_response(
+                    user_message, self._context(conversation), on_delta, usage
+                )
+        else:
+            # Fallback to direct Mistral processing
             response = self.mistral_service.generate_response(
-                user_message, conversation
+                user_message, self._context(conversation), on_delta, usage
             )
-            next_step = current_step.next_step
+            next_step_id = KEEP
 
-        elif current_step.step_type == "api_call":
-            # Handle API calls (simplified)
-            response = f"API call would be made: {current_step.content}"
-            next_step = current_step.next_step
+        turn = self._turn(current_step, user_message, response, started, usage)
+        self._save_turn(conversation, summary, turn, next_step_id)
+        return response
 
+    async def aprocess_message(self, user_message, on_delta=None):
+        """Process user message according to scenario using the async ORM
+
+        The bot must come with settings and scenario already loaded, lazy
+        relations cannot be fetched from a coroutine.
+        """
+        started = time.monotonic()
+        graph = None
+        if self.bot.scenario:
+            graph = await aget_scenario_graph(self.bot.scenario)
+        conversation = await self._conversations().afirst()
+        conversation = self._start(conversation, graph)
+        summary = conversation.context_data.get("summary")
+        usage = {}
+
+        current_step = graph.step(conversation.current_step_id) if graph else None
+        if current_step:
+            response, next_step_id = self._resolve_step(current_step, graph)
+            if response is None:
+                response = await self.mistral_service.agenerate_response(
+                    user_message, self._context(conversation), on_delta, usage
+                )
         else:
-            response = self.mistral_service.generate_response(
-                user_message, conversation
+            response = await self.mistral_service.agenerate_response(
+                user_message, self._context(conversation), on_delta, usage
             )
-            next_step = None
+            next_step_id = KEEP
+
+        turn = self._turn(current_step, user_message, response, started, usage)
+        # transaction.atomic() is not available to async code, so the write
+        # phase runs in a worker thread
+        await sync_to_async(self._save_turn)(conversation, summary, turn, next_step_id)
+        return response
 
-        # Save bot response
-        Message.objects.create(
-            conversation=conversation, step=current_step, bot_message=response
+    def _conversations(self):
+        # The newest message id comes along to check the cached history
+        return Conversation.objects.filter(
+            bot=self.bot, user_identifier=self.user_identifier
+        ).annotate(last_message_id=last_message_id())
+
+    def _start(self, conversation, graph):
+        """Existing conversation, or a new unsaved one at the initial step"""
+        if conversation is not None:
+            return conversation
+        return Conversation(
+            bot=self.bot,
+            user_identifier=self.user_identifier,
+            is_active=True,
+            current_step_id=graph.initial_step_id if graph else None,
         )
 
-        # Update conversation state
-        if next_step:
-            conversation.current_step = next_step
-        else:
-            conversation.current_step = None
-        conversation.save()
+    def _context(self, conversation):
+        # A conversation that is not saved yet has no history to load
+        return None if conversation._state.adding else conversation
+
+    def _turn(self, step, user_message, response, started, usage):
+        """Unsaved Message row holding the whole exchange"""
+        return Message(
+            step_id=step.id if step else None,
+            user_message=user_message,
+            bot_message=response,
+            latency_ms=round((time.monotonic() - started) * 1000),
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+        )
 
-        return response
+    def _save_turn(self, conversation, summary, turn, next_step_id):
+        """Store the turn and move the conversation to next_step_id
 
-    def _process_with_mistral(self, conversation, user_message):
-        """Fallback to direct Mistral processing"""
-        response = self.mistral_service.generate_response(user_message, conversation)
+        summary is the conversation's rolling summary before the Mistral
+        call, context_data is saved only when the call replaced it.
+        """
+        try:
+            self._write_turn(conversation, summary, turn, next_step_id)
+        except IntegrityError:
+            if not conversation._state.adding:
+                raise
+            # Another worker created the conversation first, append to it
+            conversation = self._conversations().get()
+            summary = conversation.context_data.get("summary")
+            self._write_turn(conversation, summary, turn, next_step_id)
+
+    def _write_turn(self, conversation, summary, turn, next_step_id):
+        update_fields = []
+        if next_step_id is not KEEP:
+            conversation.current_step_id = next_step_id
+            update_fields.append("current_step")
+        if conversation.context_data.get("summary") is not summary:
+            update_fields.append("context_data")
+        created = conversation._state.adding
+        with transaction.atomic():
+            if created:
+                conversation.save(force_insert=True)
+            elif update_fields:
+                conversation.save(update_fields=update_fields + ["updated_at"])
+            turn.conversation = conversation
+            turn.save(force_insert=True)
+            transaction.on_commit(
+                lambda: append_history(
+                    conversation.pk,
+                    [(turn.pk, turn.user_message, turn.bot_message)],
+                    created,
+                )
+            )
 
-        # Save messages
-        Message.objects.create(conversation=conversation, user_message=user_message)
-        Message.objects.create(conversation=conversation, bot_message=response)
+    def _resolve_step(self, current_step, graph):
+        """Return scripted response (None when Mistral answers) and next step id"""
+        next_step = graph.next_step(current_step)
+        next_step_id = next_step.id if next_step else None
 
-        return response
+        # Handle different step types
+        if current_step.step_type == "message":
+            return current_step.content, next_step_id
+
+        elif current_step.step_type == "question":
+            return None, next_step_id
+
+        elif current_step.step_type == "api_call":
+            # Handle API calls (simplified)
+            response = f"API call would be made: {current_step.content}"
+            return response, next_step_id
+
+        return None, None
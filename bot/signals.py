@@ -0,0 +1,41 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .history import drop_history
+from .models import Bot, BotSettings, Conversation, Scenario, Step
+from .registry import registry
+from .scenario_graph import invalidate_scenario
+
+
+def bump_scenario_version(scenario_id):
+    """Mark compiled copies of the scenario in every process as stale"""
+    Scenario.objects.filter(pk=scenario_id).update(version=F("version") + 1)
+    invalidate_scenario(scenario_id)
+
+
+@receiver([post_save, post_delete], sender=Step)
+def step_changed(sender, instance, **kwargs):
+    bump_scenario_version(instance.scenario_id)
+
+
+@receiver([post_save, post_delete], sender=Scenario)
+def scenario_changed(sender, instance, **kwargs):
+    # Scenario.save() itself moves the version forward
+    invalidate_scenario(instance.pk)
+    registry.invalidate_scenario(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Bot)
+def bot_changed(sender, instance, **kwargs):
+    registry.invalidate_bot(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=BotSettings)
+def bot_settings_changed(sender, instance, **kwargs):
+    registry.invalidate_bot(instance.bot_id)
+
+
+@receiver(post_delete, sender=Conversation)
+def conversation_deleted(sender, instance, **kwargs):
+    drop_history(instance.pk)
@@ -0,0 +1,231 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from django.conf import settings
+
+from .local_store import LocalStore, store_path
+
+
+class SharedFlights(LocalStore):
+    """Requests in flight in any process on the host and their results
+
+    A result is kept only briefly and only returned to callers that
+    joined the flight that produced it, it is not a cache.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS flights (
+        key TEXT PRIMARY KEY,
+        started_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS results (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        finished_at REAL NOT NULL
+    );
+    """
+    keep_results = 60
+
+    def lead(self, key, lease):
+        """Start a flight for key, or return the start time of a running one"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT started_at FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+            # Полет старше lease считаем брошенным упавшим процессом
+            if row and row[0] > now - lease:
+                return row[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO flights (key, started_at) VALUES (?, ?)",
+                (key, now),
+            )
+        return None
+
+    def land(self, key, value):
+        """End the flight with its result for the waiting processes"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM flights WHERE key = ?", (key,))
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, finished_at) "
+                "VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            conn.execute(
+                "DELETE FROM results WHERE finished_at < ?", (now - self.keep_results,)
+            )
+
+    def abandon(self, key):
+        """End the flight without a result, a waiting process takes over"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM flights WHERE key = ?", (key,))
+
+    def outcome(self, key, started_at):
+        """(result, still_flying) of the flight that started at started_at"""
+        conn = self.connection
+        row = conn.execute(
+            "SELECT value, finished_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row and row[1] >= started_at:
+            return row[0], False
+        flying = conn.execute(
+            "SELECT 1 FROM flights WHERE key = ? AND started_at = ?",
+            (key, started_at),
+        ).fetchone()
+        return None, flying is not None
+
+
+class SingleFlight:
+    """Runs one call per key at a time, concurrent callers share its result
+
+    Callers in this process, threads and coroutines alike, wait for the
+    leader's future. The leader itself first joins a flight of another
+    process through SharedFlights when there is one, waiting at most
+    lease seconds before making the call on its own.
+    """
+
+    def __init__(self, shared=None, lease=60, poll_interval=0.05):
+        self.shared = shared
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "coalesced": 0,
+            "coalesced_shared": 0,
+            "takeovers": 0,
+        }
+
+    def do(self, key, call):
+        """Result of call(), shared by concurrent callers with the same key"""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            value = self._lead(key, call)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, value)
+        return value
+
+    async def ado(self, key, call):
+        """Result of await call(), see do"""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await self._alead(key, call)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._flights))
+
+    def _lead(self, key, call):
+        while self.shared is not None:
+            started_at = self.shared.lead(key, self.lease)
+            if started_at is None:
+                break
+            deadline = time.monotonic() + self.lease
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                value, flying = self.shared.outcome(key, started_at)
+                if value is not None:
+                    self._count("coalesced_shared")
+                    return value
+                if not flying:
+                    break
+            self._count("takeovers")
+
+        self._count("calls")
+        try:
+            value = call()
+        except BaseException:
+            if self.shared is not None:
+                self.shared.abandon(key)
+            raise
+        if self.shared is not None:
+            self.shared.land(key, value)
+        return value
+
+    async def _alead(self, key, call):
+        # Файл общий для процессов, его блокировки не должны держать цикл
+        while self.shared is not None:
+            started_at = await asyncio.to_thread(self.shared.lead, key, self.lease)
+            if started_at is None:
+                break
+            deadline = time.monotonic() + self.lease
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                value, flying = await asyncio.to_thread(
+                    self.shared.outcome, key, started_at
+                )
+                if value is not None:
+                    self._count("coalesced_shared")
+                    return value
+                if not flying:
+                    break
+            self._count("takeovers")
+
+        self._count("calls")
+        try:
+            value = await call()
+        except BaseException:
+            if self.shared is not None:
+                await asyncio.to_thread(self.shared.abandon, key)
+            raise
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.land, key, value)
+        return value
+
+    def _join(self, key):
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return future, False
+            future = self._flights[key] = concurrent.futures.Future()
+            return future, True
+
+    def _finish(self, key, future, value=None, error=None):
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is None:
+            future.set_result(value)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # Отмена ведущего не должна выглядеть отменой ожидающих
+            future.set_exception(RuntimeError("Coalesced request was cancelled"))
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+_flight = None
+_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Process-wide SingleFlight configured from settings"""
+    global _flight
+    if _flight is None:
+        with _flight_lock:
+            if _flight is None:
+                shared = None
+                if settings.MISTRAL_SINGLE_FLIGHT_SHARED:
+                    shared = SharedFlights(
+                        store_path(settings.MISTRAL_SINGLE_FLIGHT_FILE)
+                    )
+                _flight = SingleFlight(shared, settings.MISTRAL_SINGLE_FLIGHT_LEASE)
+    return _flight
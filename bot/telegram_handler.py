@@ -2,17 +2,139 @@ import telegram
 
 # import logger
 from telegram import Update
-from .services import ScenarioProcessor
+from .delivery import get_delivery, split_text
+from .services import MistralService, ScenarioProcessor
+from django.conf import settings
+from functools import cached_property
+import asyncio
+import concurrent.futures
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+WELCOME_TEXT = """
+🤖 *Welcome to AI Bot!*
+
+I'm powered by Mistral AI and ready to help you with:
+
+💬 General conversations
+📚 Answering questions  
+🔍 Problem solving
+💡 Creative tasks
+
+Just send me a message and I'll respond!
+
+*Commands:*
+/start - Show this welcome message
+/help - Get help information
+
+Let's start chatting! 🎉
+        """
+
+
+class StreamingReply:
+    """One Telegram message that grows while Mistral streams the answer
+
+    The first chunk is sent right away, later chunks are folded into
+    edit_message_text calls at most once per TELEGRAM_STREAM_EDIT_INTERVAL.
+
+    telegram_bot is expected to keep within the flood limits itself, see
+    TelegramDelivery.outbound.
+    """
+
+    def __init__(self, telegram_bot, chat_id, reply_to_message_id=None):
+        self.telegram_bot = telegram_bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.message_id = None
+        self.shown = ""
+        self.last_edit = 0.0
+
+    async def update(self, text):
+        """Show partial answer if the edit budget allows it
+
+        A failed send or edit is only logged, the answer keeps streaming and
+        finish shows it whole.
+        """
+        text = split_text(text)[0]
+        try:
+            if self.message_id is None:
+                await self._send_first(text)
+            elif (
+                text != self.shown
+                and time.monotonic() - self.last_edit
+                >= settings.TELEGRAM_STREAM_EDIT_INTERVAL
+            ):
+                await self._edit(text)
+        except Exception as e:
+            logger.warning(f"Partial answer to {self.chat_id} not shown: {e}")
+
+    async def finish(self, text):
+        """Show the complete answer, sending overflow as extra messages"""
+        head, *tail = split_text(text)
+        if self.message_id is None:
+            await self._send_first(head)
+        elif head != self.shown:
+            await self._edit(head)
+        for chunk in tail:
+            await self.telegram_bot.send_message(chat_id=self.chat_id, text=chunk)
+
+    async def _send_first(self, text):
+        message = await self.telegram_bot.send_message(
+            chat_id=self.chat_id,
+            text=text,
+            reply_to_message_id=self.reply_to_message_id,
+        )
+        self.message_id = message.message_id
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+    async def _edit(self, text):
+        await self.telegram_bot.edit_message_text(
+            text, chat_id=self.chat_id, message_id=self.message_id
+        )
+        self.shown = text
+        self.last_edit = time.monotonic()
+
 
 class TelegramBotHandler:
     def __init__(self, bot):
         self.bot = bot
         self.telegram_bot = telegram.Bot(token=bot.token)
 
+    @cached_property
+    def mistral_service(self):
+        """Shared by all chats of the bot, created on the first message"""
+        return MistralService(self.bot)
+
+    def _deliver(self, method, **kwargs):
+        """Make a Bot API call on the delivery loop, raise if it failed"""
+        return get_delivery().send(self.bot.token, method, **kwargs).unwrap()
+
+    def _deliver_text(self, chat_id, text, **kwargs):
+        """Queue text for the chat and wait until it is sent, raise if it failed
+
+        A send still waiting for the flood limits after
+        TELEGRAM_DELIVERY_TIMEOUT stays queued and is not waited for.
+        """
+        future = get_delivery().queue_text(self.bot.token, chat_id, text, **kwargs)
+        try:
+            return future.result(settings.TELEGRAM_DELIVERY_TIMEOUT).unwrap()
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"Message to {chat_id} is still queued for delivery")
+            return None
+
+    async def _adeliver(self, method, **kwargs):
+        """Make a Bot API call from a coroutine, raise if it failed"""
+        future = get_delivery().call(self.bot.token, method, **kwargs)
+        return (await asyncio.wrap_future(future)).unwrap()
+
+    async def _adeliver_text(self, chat_id, text, **kwargs):
+        """Send text to the chat from a coroutine, raise if it failed"""
+        future = get_delivery().queue_text(self.bot.token, chat_id, text, **kwargs)
+        return (await asyncio.wrap_future(future)).unwrap()
+
     def set_webhook(self):
         """Set webhook for Telegram bot"""
         try:
@@ -22,7 +144,7 @@ class TelegramBotHandler:
             )
 
             # Устанавливаем вебхук
-            result = self.telegram_bot.set_webhook(webhook_url)
+            self._deliver("set_webhook", url=webhook_url)
 
             # Сохраняем URL вебхука в базе данных
             self.bot.webhook_url = "https://5f67e7e732a807.lhr.life"
@@ -40,7 +162,7 @@ class TelegramBotHandler:
     def delete_webhook(self):
         """Delete webhook for Telegram bot"""
         try:
-            self.telegram_bot.delete_webhook()
+            self._deliver("delete_webhook")
             logger.info(f"Webhook deleted for bot {self.bot.name}")
             return True
         except Exception as e:
@@ -50,13 +172,18 @@ class TelegramBotHandler:
     def get_webhook_info(self):
         """Get webhook information"""
         try:
-            return self.telegram_bot.get_webhook_info()
+            return self._deliver("get_webhook_info")
         except Exception as e:
             logger.error(f"Error getting webhook info for bot {self.bot.name}: {e}")
             return None
 
-    def handle_update(self, update_data):
-        """Handle incoming Telegram update"""
+    def handle_update(self, update_data, raise_errors=False):
+        """Handle incoming Telegram update
+
+        With raise_errors a message that failed before its answer was
+        saved raises instead of getting an error reply, so the update
+        queue can retry it.
+        """
         logger.info(f"Received update for bot {self.bot.name}")
 
         try:
@@ -67,6 +194,7 @@ class TelegramBotHandler:
                     update.message.chat.id,
                     update.message.text,
                     update.message.message_id,
+                    raise_errors,
                 )
             elif update.callback_query:
                 self._process_callback(update.callback_query)
@@ -75,9 +203,33 @@ class TelegramBotHandler:
 
         except Exception as e:
             logger.error(f"Error handling update for bot {self.bot.name}: {e}")
+            if raise_errors:
+                raise
+
+    async def ahandle_update(self, update_data):
+        """Handle incoming Telegram update, awaiting every Bot API call"""
+        logger.info(f"Received update for bot {self.bot.name}")
+
+        try:
+            update = Update.de_json(update_data, self.telegram_bot)
+
+            if update.message and update.message.text:
+                await self._aprocess_message(
+                    update.message.chat.id,
+                    update.message.text,
+                    update.message.message_id,
+                )
+            elif update.callback_query:
+                await self._aprocess_callback(update.callback_query)
+            else:
+                logger.warning(f"Unhandled update type: {update_data}")
 
-    def _process_message(self, chat_id, text, message_id=None):
+        except Exception as e:
+            logger.error(f"Error handling update for bot {self.bot.name}: {e}")
+
+    def _process_message(self, chat_id, text, message_id=None, raise_errors=False):
         """Process incoming message"""
+        response = None
         try:
             logger.info(f"Processing message from {chat_id}: {text}")
 
@@ -87,22 +239,65 @@ class TelegramBotHandler:
                     self._send_welcome_message(chat_id)
                 return
 
-            processor = ScenarioProcessor(self.bot, str(chat_id))
-            response = processor.process_message(text)
+            # Частичный ответ показываем по мере генерации, вызовы Bot API
+            # выполняются в цикле доставки
+            delivery = get_delivery()
+            reply = StreamingReply(
+                delivery.outbound(self.bot.token), chat_id, message_id
+            )
+            processor = ScenarioProcessor(self.bot, str(chat_id), self.mistral_service)
+            response = processor.process_message(
+                text, on_delta=lambda partial: delivery.run(reply.update(partial))
+            )
+
+            # Отправляем ответ; ожидающий лимитов ответ остается в очереди
+            try:
+                delivery.run(reply.finish(response), settings.TELEGRAM_DELIVERY_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                logger.warning(f"Response to {chat_id} is still queued for delivery")
+                return
+
+            logger.info(f"Response sent to {chat_id}")
+
+        except Exception as e:
+            logger.error(f"Error processing message for bot {self.bot.name}: {e}")
+            # Пока ответ не сохранен, обновление можно безопасно повторить
+            if raise_errors and response is None:
+                raise
+            try:
+                self._deliver_text(
+                    chat_id,
+                    "❌ Sorry, I encountered an error. Please try again later.",
+                )
+            except Exception as send_error:
+                logger.error(f"Failed to send error message: {send_error}")
+
+    async def _aprocess_message(self, chat_id, text, message_id=None):
+        """Process incoming message from a coroutine"""
+        try:
+            logger.info(f"Processing message from {chat_id}: {text}")
 
-            # Отправляем ответ
-            self.telegram_bot.send_message(
-                chat_id=chat_id, text=response, reply_to_message_id=message_id
+            if text.startswith("/"):
+                if text == "/start":
+                    await self._asend_welcome_message(chat_id)
+                return
+
+            reply = StreamingReply(
+                get_delivery().outbound(self.bot.token), chat_id, message_id
             )
+            processor = ScenarioProcessor(self.bot, str(chat_id), self.mistral_service)
+            response = await processor.aprocess_message(text, on_delta=reply.update)
+
+            await reply.finish(response)
 
             logger.info(f"Response sent to {chat_id}")
 
         except Exception as e:
             logger.error(f"Error processing message for bot {self.bot.name}: {e}")
             try:
-                self.telegram_bot.send_message(
-                    chat_id=chat_id,
-                    text="❌ Sorry, I encountered an error. Please try again later.",
+                await self._adeliver_text(
+                    chat_id,
+                    "❌ Sorry, I encountered an error. Please try again later.",
                 )
             except Exception as send_error:
                 logger.error(f"Failed to send error message: {send_error}")
@@ -115,50 +310,53 @@ class TelegramBotHandler:
 
             # Обработка callback данных
             if data == "help":
-                self.telegram_bot.send_message(
-                    chat_id=chat_id,
-                    text="ℹ️ I'm an AI-powered bot. Just send me a message and I'll respond!",
+                self._deliver_text(
+                    chat_id,
+                    "ℹ️ I'm an AI-powered bot. Just send me a message and I'll respond!",
                 )
 
             # Ответим на callback (убираем "часики")
-            self.telegram_bot.answer_callback_query(callback_query.id)
+            self._deliver("answer_callback_query", callback_query_id=callback_query.id)
 
         except Exception as e:
             logger.error(f"Error processing callback: {e}")
 
-    def _send_welcome_message(self, chat_id):
-        """Send welcome message"""
-        welcome_text = """
-🤖 *Welcome to AI Bot!*
+    async def _aprocess_callback(self, callback_query):
+        """Process callback queries from a coroutine"""
+        try:
+            chat_id = callback_query.message.chat.id
 
-I'm powered by Mistral AI and ready to help you with:
+            if callback_query.data == "help":
+                await self._adeliver_text(
+                    chat_id,
+                    "ℹ️ I'm an AI-powered bot. Just send me a message and I'll respond!",
+                )
 
-💬 General conversations
-📚 Answering questions  
-🔍 Problem solving
-💡 Creative tasks
+            await self._adeliver(
+                "answer_callback_query", callback_query_id=callback_query.id
+            )
 
-Just send me a message and I'll respond!
+        except Exception as e:
+            logger.error(f"Error processing callback: {e}")
 
-*Commands:*
-/start - Show this welcome message
-/help - Get help information
+    def _send_welcome_message(self, chat_id):
+        """Send welcome message"""
+        try:
+            self._deliver_text(chat_id, WELCOME_TEXT, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error sending welcome message: {e}")
 
-Let's start chatting! 🎉
-        """
+    async def _asend_welcome_message(self, chat_id):
+        """Send welcome message from a coroutine"""
         try:
-            self.telegram_bot.send_message(
-                chat_id=chat_id, text=welcome_text, parse_mode="Markdown"
-            )
+            await self._adeliver_text(chat_id, WELCOME_TEXT, parse_mode="Markdown")
         except Exception as e:
             logger.error(f"Error sending welcome message: {e}")
 
     def send_message(self, chat_id, text, parse_mode=None):
         """Send message to Telegram user"""
         try:
-            self.telegram_bot.send_message(
-                chat_id=chat_id, text=text, parse_mode=parse_mode
-            )
+            self._deliver_text(chat_id, text, parse_mode=parse_mode)
             return True
         except Exception as e:
             logger.error(f"Error sending message to {chat_id}: {e}")
@@ -1,2 +1,1638 @@
+import asyncio
+import concurrent.futures
+import gzip
+import importlib
+import json
+import tempfile
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from .archive import FIELDS, MessageArchive, archive_bot_messages
+from .broadcast import run_broadcast
+from .context import message_tokens
+from .dedup import SeenUpdates, UpdateDeduplicator
+from .delivery import DeliveryResult, TelegramDelivery, split_text
+from .export import export_rows
+from .mistral_client import MistralAPIClient
+from .models import (
+    Bot,
+    BotSettings,
+    BroadcastJob,
+    Conversation,
+    Message,
+    Scenario,
+    Step,
+)
+from .polling import BotPoller, PollingOffsets, PollingSupervisor
+from .rate_limit import RateLimitExceeded, TokenBucketLimiter
+from .registry import registry
+from .response_cache import PersistentResponseStore, ResponseCache, cache_key
+from .scenario_graph import get_scenario_graph, invalidate_scenario
+from .serializers import ConversationSerializer, MessageSerializer
+from .services import (
+    BUSY_RESPONSE,
+    SUMMARY_HEADER,
+    MistralService,
+    ScenarioProcessor,
+    SystemPromptCache,
+)
+from .single_flight import SharedFlights, SingleFlight
+from .telegram_handler import TelegramBotHandler
+from .update_queue import UpdateDispatcher, UpdateQueue
+
+
+def use_temporary_store(test):
+    """Keep the local stores a test touches in a temporary directory
+
+    The process-wide stores are rebuilt inside it and restored afterwards.
+    """
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    overridden = override_settings(BOT_LOCAL_STORE_DIR=directory.name)
+    overridden.enable()
+    test.addCleanup(overridden.disable)
+    for name in ("rate_limit._limiter", "single_flight._flight", "dedup._dedup"):
+        patcher = mock.patch(f"bot.{name}", None)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return directory.name
+
+
+class ScenarioProcessorQueryBudgetTests(TestCase):
+    """Keep the query budget documented on ScenarioProcessor
+
+    TestCase wraps every test in a transaction, so each atomic() block
+    adds a SAVEPOINT and a RELEASE SAVEPOINT to the counts below.
+    """
+
+    def setUp(self):
+        use_temporary_store(self)
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        self.scenario = Scenario.objects.create(name="Flow", owner=owner)
+        ask = Step.objects.create(
+            scenario=self.scenario,
+            name="ask",
+            step_type="question",
+            content="What do you need?",
+            order=2,
+        )
+        self.hello = Step.objects.create(
+            scenario=self.scenario,
+            name="hello",
+            step_type="message",
+            content="Hi!",
+            order=1,
+            next_step=ask,
+        )
+        self.ask = ask
+        self.scenario.initial_step = self.hello
+        self.scenario.save()
+        self.bot = Bot.objects.create(
+            name="bot", token="123:abc", owner=owner, scenario=self.scenario
+        )
+        BotSettings.objects.create(
+            bot=self.bot, mistral_api_key="key", max_requests_per_minute=0
+        )
+        self.bot = Bot.objects.select_related("settings", "scenario").get(
+            pk=self.bot.pk
+        )
+        get_scenario_graph(self.bot.scenario)
+
+        patcher = mock.patch(
+            "bot.services.MistralAPIClient.chat_completion", side_effect=self.complete
+        )
+        self.chat_completion = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def complete(self, *args, usage=None, **kwargs):
+        usage.update(prompt_tokens=12, completion_tokens=1)
+        return "LLM"
+
+    def processor(self):
+        return ScenarioProcessor(self.bot, "42")
+
+    def test_first_message_of_a_chat(self):
+        # SELECT conversation, INSERT conversation, INSERT message
+        with self.assertNumQueries(5):
+            response = self.processor().process_message("hello")
+
+        self.assertEqual(response, "Hi!")
+        conversation = Conversation.objects.get(user_identifier="42")
+        self.assertEqual(conversation.current_step_id, self.ask.id)
+        self.assertEqual(conversation.messages.count(), 1)
+
+    def test_scripted_step(self):
+        Conversation.objects.create(
+            bot=self.bot, user_identifier="42", current_step=self.hello
+        )
+
+        # SELECT conversation, INSERT message, UPDATE conversation
+        with self.assertNumQueries(5):
+            response = self.processor().process_message("hello")
+
+        self.assertEqual(response, "Hi!")
+        self.chat_completion.assert_not_called()
+
+    def test_mistral_step(self):
+        conversation = Conversation.objects.create(
+            bot=self.bot, user_identifier="42", current_step=self.ask
+        )
+
+        # SELECT conversation, SELECT history, INSERT message,
+        # UPDATE conversation
+        with self.assertNumQueries(6):
+            response = self.processor().process_message("a question")
+
+        self.assertEqual(response, "LLM")
+        conversation.refresh_from_db()
+        self.assertIsNone(conversation.current_step_id)
+        self.assertEqual(
+            list(
+                Message.objects.filter(conversation=conversation).values_list(
+                    "step_id", "user_message", "bot_message", "prompt_tokens"
+                )
+            ),
+            [(self.ask.id, "a question", "LLM", 12)],
+        )
+
+    def test_mistral_step_with_cached_history(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.processor().process_message("hello")
+
+        # The history comes from the ring buffer written on commit
+        with self.assertNumQueries(5):
+            self.processor().process_message("a question")
+
+        messages = self.chat_completion.call_args.kwargs["messages"]
+        self.assertEqual(
+            [(m["role"], m["content"]) for m in messages[1:]],
+            [
+                ("user", "hello"),
+                ("assistant", "Hi!"),
+                ("user", "a question"),
+            ],
+        )
+
+    def test_turn_stored_by_another_process_reloads_history(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.processor().process_message("hello")
+        # Written elsewhere, this process's ring buffer never saw it
+        Message.objects.create(
+            conversation=Conversation.objects.get(),
+            user_message="from another worker",
+            bot_message="ok",
+        )
+
+        # One SELECT more than with the buffer: the history is loaded again
+        with self.assertNumQueries(6):
+            self.processor().process_message("a question")
+
+        messages = self.chat_completion.call_args.kwargs["messages"]
+        self.assertEqual(
+            [m["content"] for m in messages[-3:]],
+            ["from another worker", "ok", "a question"],
+        )
+
+    def test_old_messages_folded_into_summary(self):
+        self.bot.settings.context_token_budget = 170
+        conversation = Conversation.objects.create(
+            bot=self.bot, user_identifier="42", current_step=self.ask
+        )
+        for n in range(4):
+            Message.objects.create(
+                conversation=conversation,
+                user_message=f"q{n} " * 40,
+                bot_message=f"a{n}",
+            )
+
+        # The new summary is written by the same UPDATE as the step
+        with self.assertNumQueries(6):
+            self.processor().process_message("a question")
+
+        messages = self.chat_completion.call_args.kwargs["messages"]
+        self.assertEqual(messages[1]["role"], "system")
+        self.assertIn("User: q2", messages[1]["content"])
+        self.assertEqual(
+            messages[-2:],
+            [
+                {"role": "assistant", "content": "a3"},
+                {"role": "user", "content": "a question"},
+            ],
+        )
+        conversation.refresh_from_db()
+        summary = conversation.context_data["summary"]
+        # The summary keeps its share of the budget, the oldest lines go first
+        self.assertTrue(summary["text"].startswith("User: q2"))
+        self.assertNotIn("q3", summary["text"])
+        self.assertEqual(
+            summary["through_id"], Message.objects.get(user_message__startswith="q2").pk
+        )
+
+    def test_prompt_with_a_growing_summary_stays_within_budget(self):
+        self.bot.settings.context_token_budget = 2000
+        conversation = Conversation.objects.create(
+            bot=self.bot, user_identifier="42", current_step=self.ask
+        )
+        for n in range(14):
+            Message.objects.create(
+                conversation=conversation,
+                user_message=f"q{n} " * 300,
+                bot_message=f"a{n} " * 100,
+            )
+
+        for n in range(3):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.processor().process_message(f"question {n}")
+            messages = self.chat_completion.call_args.kwargs["messages"]
+            self.assertLessEqual(sum(message_tokens(m) for m in messages), 2000)
+            self.assertTrue(messages[1]["content"].startswith(SUMMARY_HEADER))
+
+    @override_settings(BOT_HISTORY_SIZE=3)
+    def test_rows_leaving_the_buffer_are_summarized(self):
+        conversation = Conversation.objects.create(bot=self.bot, user_identifier="42")
+        for n in range(5):
+            Message.objects.create(
+                conversation=conversation, user_message=f"q{n}", bot_message=f"a{n}"
+            )
+
+        # q0 and q1 left the buffer before any summary, they are loaded once
+        with self.captureOnCommitCallbacks(execute=True):
+            self.processor().process_message("q5")
+        messages = self.chat_completion.call_args.kwargs["messages"]
+        self.assertEqual(
+            messages[1]["content"].splitlines()[1:],
+            ["User: q0", "Assistant: a0", "User: q1", "Assistant: a1"]
+            + ["User: q2", "Assistant: a2"],
+        )
+        self.assertEqual(
+            [m["content"] for m in messages[2:]], ["q3", "a3", "q4", "a4", "q5"]
+        )
+
+        # Afterwards each row is folded before it leaves, no extra SELECT:
+        # SELECT conversation, INSERT message, UPDATE conversation
+        with self.assertNumQueries(5):
+            self.processor().process_message("q6")
+        conversation.refresh_from_db()
+        self.assertIn("User: q3", conversation.context_data["summary"]["text"])
+
+    def test_bot_without_scenario(self):
+        self.bot.scenario = None
+        Conversation.objects.create(bot=self.bot, user_identifier="42")
+
+        # SELECT conversation, SELECT history, INSERT message
+        with self.assertNumQueries(5):
+            response = self.processor().process_message("hi")
+
+        self.assertEqual(response, "LLM")
+
+
+class MistralHttpPoolTests(SimpleTestCase):
+    def setUp(self):
+        requests_seen = self.requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                requests_seen.append(
+                    (self.client_address[1], self.headers["Authorization"])
+                )
+                body = json.dumps(
+                    {"choices": [{"message": {"content": "pong"}}], "usage": {}}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_port}"
+
+        patcher = mock.patch("bot.mistral_client._session", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_clients_of_all_bots_share_one_connection(self):
+        clients = [MistralAPIClient(key, base_url=self.url) for key in ("a", "b")]
+        for client in clients * 2:
+            self.assertEqual(client.chat_completion("model", []), "pong")
+        clients[0].session.close()
+
+        self.assertIs(clients[0].session, clients[1].session)
+        self.assertEqual(len({port for port, _ in self.requests_seen}), 1)
+        self.assertEqual(
+            [auth for _, auth in self.requests_seen],
+            ["Bearer a", "Bearer b", "Bearer a", "Bearer b"],
+        )
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_hit_miss_and_expiry(self):
+        responses = ResponseCache(max_bytes=1000)
+        with mock.patch("bot.response_cache.time.time", return_value=1000.0):
+            responses.set("key", "answer", ttl=60)
+            self.assertEqual(responses.get("key"), "answer")
+            self.assertIsNone(responses.get("other"))
+        with mock.patch("bot.response_cache.time.time", return_value=1060.0):
+            self.assertIsNone(responses.get("key"))
+
+        stats = responses.stats()
+        self.assertEqual((stats["memory_hits"], stats["misses"]), (1, 2))
+        self.assertEqual((stats["entries"], stats["bytes"]), (0, 0))
+
+    def test_least_recently_used_answer_is_evicted_first(self):
+        # Every entry takes 2 bytes: a one-letter key and a one-letter answer
+        responses = ResponseCache(max_bytes=6)
+        for key in "abc":
+            responses.set(key, key.upper(), ttl=60)
+        responses.get("a")
+        responses.set("d", "D", ttl=60)
+
+        self.assertEqual([responses.get(key) for key in "abcd"], ["A", None, "C", "D"])
+        self.assertEqual(responses.stats()["evictions"], 1)
+
+    def test_persistent_tier_survives_a_restart(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f"{directory.name}/responses.sqlite3"
+        ResponseCache(1000, PersistentResponseStore(path)).set("key", "answer", 60)
+
+        restarted = ResponseCache(1000, PersistentResponseStore(path))
+        self.assertEqual(restarted.get("key"), "answer")
+        self.assertEqual(restarted.get("key"), "answer")
+        stats = restarted.stats()
+        self.assertEqual((stats["persistent_hits"], stats["memory_hits"]), (1, 1))
+
+    def test_key_ignores_whitespace_noise_only(self):
+        messages = [{"role": "user", "content": "What  is\nit?"}]
+        self.assertEqual(
+            cache_key("model", 0.7, 100, messages),
+            cache_key("model", 0.7, 100, [{"role": "user", "content": "What is it?"}]),
+        )
+        self.assertNotEqual(
+            cache_key("model", 0.7, 100, messages),
+            cache_key("model", 0.2, 100, messages),
+        )
+
+
+class MistralServiceTests(TestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        bot = Bot.objects.create(name="bot", owner=owner)
+        BotSettings.objects.create(
+            bot=bot,
+            mistral_api_key="key",
+            max_requests_per_minute=0,
+            stream_responses=True,
+            cache_responses=True,
+        )
+        self.service = MistralService(
+            Bot.objects.select_related("settings").get(pk=bot.pk)
+        )
+
+    def test_bots_do_not_share_a_flight(self):
+        other = Bot.objects.create(name="other", owner=self.service.bot.owner)
+        BotSettings.objects.create(
+            bot=other, mistral_api_key="other key", max_requests_per_minute=0
+        )
+        services = [
+            self.service,
+            MistralService(Bot.objects.select_related("settings").get(pk=other.pk)),
+        ]
+        keys = []
+
+        with mock.patch.object(
+            SingleFlight, "do", side_effect=lambda key, call: keys.append(key) or "a"
+        ):
+            for service in services:
+                service.settings.cache_responses = False
+                service.generate_response("q")
+
+        # Same prompt, but each bot pays for its own request
+        self.assertEqual(len(keys), 2)
+        self.assertNotEqual(keys[0], keys[1])
+
+    @override_settings(MISTRAL_RATE_LIMIT_MAX_WAIT=0)
+    def test_bot_over_its_quota_is_told_to_wait(self):
+        self.service.settings.max_requests_per_minute = 1
+        self.service.settings.cache_responses = False
+        with mock.patch.object(
+            self.service.client, "chat_completion", return_value="answer"
+        ) as complete:
+            responses = [self.service.generate_response("q") for _ in range(2)]
+
+        self.assertEqual(responses, ["answer", BUSY_RESPONSE])
+        complete.assert_called_once()
+
+    def test_interrupted_stream_is_not_cached(self):
+        def broken_stream(**kwargs):
+            yield "The answer is"
+            raise ConnectionError("connection reset")
+
+        shown = []
+        with mock.patch.object(
+            self.service.client, "stream_chat_completion", side_effect=broken_stream
+        ):
+            response = self.service.generate_response("q", on_delta=shown.append)
+        self.assertEqual(response, "The answer is")
+        self.assertEqual(shown, ["The answer is"])
+
+        with mock.patch.object(
+            self.service.client, "chat_completion", return_value="The answer is 42"
+        ) as complete:
+            self.assertEqual(self.service.generate_response("q"), "The answer is 42")
+        complete.assert_called_once()
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        owner = User.objects.create(username="owner")
+        bot = Bot.objects.create(name="bot", owner=owner)
+        self.settings = BotSettings.objects.create(
+            bot=bot, mistral_api_key="key", archive_after_days=30
+        )
+        self.conversation = Conversation.objects.create(bot=bot, user_identifier="42")
+
+    def test_old_messages_move_to_archive(self):
+        for n in range(3):
+            Message.objects.create(
+                conversation=self.conversation, user_message=f"q{n}", bot_message="a"
+            )
+        Message.objects.filter(user_message__in=["q0", "q1"]).update(
+            timestamp=timezone.now() - timedelta(days=40)
+        )
+
+        self.assertEqual(archive_bot_messages(self.settings, batch_size=1), 2)
+
+        self.assertEqual(
+            list(self.conversation.messages.values_list("user_message", flat=True)),
+            ["q2"],
+        )
+        archived = MessageArchive(self.settings.bot_id).conversation_messages(
+            self.conversation.pk
+        )
+        self.assertEqual([m.user_message for m in archived], ["q0", "q1"])
+        self.assertEqual(archived[0].conversation_id, self.conversation.pk)
+
+    def test_interrupted_rollover_is_not_served_twice(self):
+        for n in range(2):
+            Message.objects.create(
+                conversation=self.conversation, user_message=f"q{n}", bot_message="a"
+            )
+        # Appended to the archive, then the process died before the delete
+        MessageArchive(self.settings.bot_id).append(
+            list(Message.objects.filter(user_message="q0").values(*FIELDS))
+        )
+
+        client = APIClient()
+        client.force_authenticate(User.objects.get(username="owner"))
+        response = client.get(f"/api/conversations/{self.conversation.pk}/")
+        self.assertEqual(
+            [m["user_message"] for m in response.data["messages"]], ["q0", "q1"]
+        )
+
+
+class MergeExchangeMessagesTests(TestCase):
+    def test_answer_rows_merge_into_the_question_before_them(self):
+        migration = importlib.import_module(
+            "bot.migrations.0009_merge_exchange_messages"
+        )
+        owner = User.objects.create(username="owner")
+        bot = Bot.objects.create(name="bot", owner=owner)
+        first, second = (
+            Conversation.objects.create(bot=bot, user_identifier=user)
+            for user in ("1", "2")
+        )
+        for conversation, user_text, bot_text in [
+            (first, "q1", ""),
+            (first, "", "a1"),
+            (second, "", "welcome"),
+            (second, "q2", ""),
+            (first, "q3", ""),
+            (second, "", "a2"),
+            (first, "q4", "a4"),
+        ]:
+            Message.objects.create(
+                conversation=conversation, user_message=user_text, bot_message=bot_text
+            )
+
+        with mock.patch.object(migration, "CONVERSATIONS_PER_CHUNK", 1):
+            migration.merge_exchanges(apps, mock.Mock(connection=connection))
+
+        self.assertEqual(
+            list(
+                Message.objects.order_by("conversation_id", "pk").values_list(
+                    "conversation__user_identifier", "user_message", "bot_message"
+                )
+            ),
+            [
+                ("1", "q1", "a1"),
+                ("1", "q3", ""),
+                ("1", "q4", "a4"),
+                ("2", "", "welcome"),
+                ("2", "q2", "a2"),
+            ],
+        )
+
+    def test_merged_rows_are_written_in_chunks(self):
+        migration = importlib.import_module(
+            "bot.migrations.0009_merge_exchange_messages"
+        )
+        owner = User.objects.create(username="owner")
+        conversation = Conversation.objects.create(
+            bot=Bot.objects.create(name="bot", owner=owner), user_identifier="1"
+        )
+        for n in range(5):
+            Message.objects.create(conversation=conversation, user_message=f"q{n}")
+            Message.objects.create(conversation=conversation, bot_message=f"a{n}")
+
+        with (
+            mock.patch.object(migration, "ROWS_PER_FLUSH", 2),
+            CaptureQueriesContext(connection) as queries,
+        ):
+            migration.merge_exchanges(apps, mock.Mock(connection=connection))
+
+        deletes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith('DELETE FROM "messages"')
+        ]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(
+            list(
+                conversation.messages.order_by("pk").values_list(
+                    "user_message", "bot_message"
+                )
+            ),
+            [(f"q{n}", f"a{n}") for n in range(5)],
+        )
+
+
+class ConversationApiTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        bot = Bot.objects.create(name="bot", owner=owner)
+        self.conversations = [
+            Conversation.objects.create(bot=bot, user_identifier=str(n))
+            for n in range(3)
+        ]
+        for n in range(5):
+            Message.objects.create(
+                conversation=self.conversations[0], user_message=f"q{n}"
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def test_list_is_paginated_without_messages(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/conversations/", {"page_size": 2})
+
+        self.assertEqual(
+            [row["id"] for row in response.data["results"]],
+            [self.conversations[2].pk, self.conversations[1].pk],
+        )
+        # The values() rows render exactly like the model serializer
+        expected = dict(ConversationSerializer(self.conversations[2]).data)
+        del expected["messages"]
+        self.assertEqual(response.json()["results"][0], expected)
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual(
+            [row["id"] for row in response.data["results"]],
+            [self.conversations[0].pk],
+        )
+
+    def test_messages_are_paginated(self):
+        url = f"/api/conversations/{self.conversations[0].pk}/messages/"
+        response = self.client.get(url, {"page_size": 3})
+
+        self.assertEqual(
+            [row["user_message"] for row in response.data["results"]],
+            ["q0", "q1", "q2"],
+        )
+        first = Message.objects.get(user_message="q0")
+        self.assertEqual(response.json()["results"][0], MessageSerializer(first).data)
+        response = self.client.get(response.data["next"])
+        self.assertEqual(
+            [row["user_message"] for row in response.data["results"]],
+            ["q3", "q4"],
+        )
+
+
+class BotApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        for n in range(3):
+            scenario = Scenario.objects.create(name=f"s{n}", owner=owner)
+            Step.objects.create(
+                scenario=scenario, name="hello", step_type="message", content="Hi!"
+            )
+            bot = Bot.objects.create(name=f"bot{n}", owner=owner, scenario=scenario)
+            BotSettings.objects.create(bot=bot, mistral_api_key="key")
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def test_list_runs_constant_queries(self):
+        # Bots with settings and scenarios, then steps of all scenarios
+        with self.assertNumQueries(2):
+            self.client.get("/api/bots/")
+        # Scenario payloads come from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/bots/")
+
+        details = response.data[0]["scenario_details"]
+        self.assertEqual([step["content"] for step in details["steps"]], ["Hi!"])
+
+    def test_step_change_refreshes_cached_scenario(self):
+        self.client.get("/api/bots/")
+        Step.objects.filter(name="hello").first().delete()
+
+        response = self.client.get("/api/bots/")
+
+        self.assertEqual(
+            sorted(len(bot["scenario_details"]["steps"]) for bot in response.data),
+            [0, 1, 1],
+        )
+
+    def test_fields_and_expand(self):
+        response = self.client.get("/api/bots/", {"fields": "id,name,settings"})
+        self.assertEqual(set(response.data[0]), {"id", "name", "settings"})
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/bots/", {"expand": ""})
+        self.assertNotIn("scenario_details", response.data[0])
+        self.assertNotIn("settings", response.data[0])
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        owner = User.objects.create(username="owner")
+        self.bot = Bot.objects.create(name="bot", owner=owner)
+        other = Bot.objects.create(
+            name="other", owner=User.objects.create(username="other")
+        )
+        conversation = Conversation.objects.create(bot=self.bot, user_identifier="42")
+        self.messages = [
+            Message.objects.create(conversation=conversation, user_message=f"q{n}")
+            for n in range(3)
+        ]
+        Message.objects.create(
+            conversation=Conversation.objects.create(bot=other, user_identifier="1"),
+            user_message="foreign",
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def rows(self, response, compressed=False):
+        body = b"".join(response.streaming_content)
+        if compressed:
+            body = gzip.decompress(body)
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    def test_export_streams_own_messages(self):
+        response = self.client.get("/api/export/messages/")
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = self.rows(response)
+        self.assertEqual([row["user_message"] for row in rows], ["q0", "q1", "q2"])
+        self.assertEqual(rows[0]["bot"], self.bot.pk)
+        self.assertEqual(rows[0]["user_identifier"], "42")
+
+    def test_export_resumes_after_cursor_gzipped(self):
+        response = self.client.get(
+            "/api/export/messages/",
+            {"after_id": self.messages[0].pk, "gzip": "1"},
+        )
+
+        rows = self.rows(response, compressed=True)
+        self.assertEqual([row["user_message"] for row in rows], ["q1", "q2"])
+
+    def test_export_includes_archived_messages(self):
+        Message.objects.filter(pk__in=[m.pk for m in self.messages[:2]]).update(
+            timestamp=timezone.now() - timedelta(days=40)
+        )
+        bot_settings = BotSettings.objects.create(
+            bot=self.bot, mistral_api_key="key", archive_after_days=30
+        )
+        self.assertEqual(archive_bot_messages(bot_settings), 2)
+
+        response = self.client.get(
+            "/api/export/messages/", {"after_id": self.messages[0].pk}
+        )
+
+        rows = self.rows(response)
+        self.assertEqual([row["user_message"] for row in rows], ["q1", "q2"])
+        self.assertEqual(rows[0]["user_identifier"], "42")
+        self.assertEqual(rows[0]["bot"], self.bot.pk)
+
+    def test_archive_segment_is_streamed_not_loaded(self):
+        Message.objects.filter(conversation__bot=self.bot).update(
+            timestamp=timezone.now() - timedelta(days=40)
+        )
+        bot_settings = BotSettings.objects.create(
+            bot=self.bot, mistral_api_key="key", archive_after_days=30
+        )
+        # A rollover that died before the delete left q0 in the archive
+        MessageArchive(self.bot.pk).append(
+            list(Message.objects.filter(user_message="q0").values(*FIELDS))
+        )
+        archive_bot_messages(bot_settings, batch_size=2)
+
+        read = []
+        segment_rows = MessageArchive._read
+
+        def counted(archive, month):
+            for row in segment_rows(archive, month):
+                read.append(row["id"])
+                yield row
+
+        with mock.patch.object(MessageArchive, "_read", counted):
+            rows = export_rows([self.bot.pk], chunk_size=1)
+            self.assertEqual(next(rows)["user_message"], "q0")
+            self.assertLessEqual(len(read), 2)
+            rest = [row["user_message"] for row in rows]
+
+        self.assertEqual(rest, ["q1", "q2"])
+        self.assertEqual(len(read), 4)
+
+
+class ScenarioGraphTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.scenario = Scenario.objects.create(name="Flow", owner=owner)
+        self.step = Step.objects.create(
+            scenario=self.scenario, name="hello", step_type="message", content="Hi!"
+        )
+        self.scenario.refresh_from_db()
+        # Graphs outlive tests, an earlier scenario may have had this pk
+        invalidate_scenario(self.scenario.pk)
+
+    def test_compiled_once_until_a_step_changes(self):
+        graph = get_scenario_graph(self.scenario)
+        with self.assertNumQueries(0):
+            self.assertIs(get_scenario_graph(self.scenario), graph)
+
+        self.step.content = "Hello!"
+        self.step.save()
+
+        # Dropped in this process even for the scenario loaded before
+        fresh = get_scenario_graph(self.scenario)
+        self.assertEqual(fresh.step(self.step.pk).content, "Hello!")
+        self.scenario.refresh_from_db()
+        self.assertGreater(self.scenario.version, graph.version)
+
+    def test_change_from_another_process_is_seen_by_version(self):
+        graph = get_scenario_graph(self.scenario)
+        # Another process: no signals here, only the version moves forward
+        Step.objects.filter(pk=self.step.pk).update(content="Hello!")
+        Scenario.objects.filter(pk=self.scenario.pk).update(version=F("version") + 1)
+
+        self.assertIs(get_scenario_graph(self.scenario), graph)
+        self.scenario.refresh_from_db()
+        self.assertEqual(
+            get_scenario_graph(self.scenario).step(self.step.pk).content, "Hello!"
+        )
+
+    def test_system_prompt_is_built_once_per_version(self):
+        prompts = SystemPromptCache()
+        build = mock.Mock(side_effect=lambda steps: f"{len(steps)} steps")
+        old = get_scenario_graph(self.scenario)
+        for _ in range(3):
+            self.assertEqual(prompts.get(old, build), "1 steps")
+
+        Step.objects.create(scenario=self.scenario, name="bye", step_type="message")
+        self.scenario.refresh_from_db()
+        new = get_scenario_graph(self.scenario)
+        for _ in range(2):
+            self.assertEqual(prompts.get(new, build), "2 steps")
+        # A request still holding the old graph does not replace the new prompt
+        prompts.get(old, build)
+        self.assertEqual(prompts.get(new, build), "2 steps")
+
+        self.assertEqual(build.call_count, 3)
+        self.assertEqual(prompts.stats(), {"hits": 4, "builds": 3, "scenarios": 1})
+
+
+class BotRegistryTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+        owner = User.objects.create(username="owner")
+        self.bot = Bot.objects.create(name="bot", owner=owner, token="6:registry")
+        self.settings = BotSettings.objects.create(bot=self.bot, mistral_api_key="a")
+
+    def test_bundle_is_reused_until_the_bot_changes(self):
+        bundle = registry.get("6:registry")
+        with self.assertNumQueries(0):
+            self.assertIs(registry.get("6:registry"), bundle)
+
+        self.settings.mistral_api_key = "b"
+        self.settings.save()
+        bundle = registry.get("6:registry")
+        self.assertEqual(bundle.bot.settings.mistral_api_key, "b")
+
+        self.bot.is_active = False
+        self.bot.save()
+        self.assertIsNone(registry.get("6:registry"))
+        self.assertIsNone(registry.get("0:unknown"))
+
+    def test_changes_of_other_processes_are_seen_after_the_ttl(self):
+        registry.get("6:registry")
+        # Another process: no signals reach this one
+        Bot.objects.filter(pk=self.bot.pk).update(name="renamed")
+
+        self.assertEqual(registry.get("6:registry").bot.name, "bot")
+        with override_settings(BOT_REGISTRY_TTL=0):
+            self.assertEqual(registry.get("6:registry").bot.name, "renamed")
+
+
+class ScenarioGraphImportTests(TestCase):
+    document = {
+        "name": "Survey",
+        "description": "",
+        "is_active": True,
+        "initial_step": "hello",
+        "steps": [
+            {
+                "ref": "hello",
+                "name": "hello",
+                "step_type": "message",
+                "content": "Hi!",
+                "order": 1,
+                "next_step": "ask",
+                "metadata": {},
+            },
+            {
+                "ref": "ask",
+                "name": "ask",
+                "step_type": "question",
+                "content": "How are you?",
+                "order": 2,
+                "next_step": None,
+                "metadata": {"topic": "mood"},
+            },
+        ],
+    }
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="owner"))
+
+    def test_import_and_export_round_trip(self):
+        response = self.client.post(
+            "/api/scenarios/import/", self.document, format="json"
+        )
+
+        self.assertEqual(response.status_code, 201)
+        scenario = Scenario.objects.get(pk=response.data["id"])
+        hello = scenario.steps.get(name="hello")
+        self.assertEqual(scenario.initial_step, hello)
+        self.assertEqual(hello.next_step, scenario.steps.get(name="ask"))
+        self.assertEqual(scenario.version, 2)
+
+        response = self.client.get(f"/api/scenarios/{scenario.pk}/export/")
+        self.assertEqual(response.json(), self.document)
+
+    def test_unknown_ref_rejects_whole_document(self):
+        document = dict(self.document, initial_step="missing")
+
+        response = self.client.post("/api/scenarios/import/", document, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("initial_step", response.data)
+        self.assertFalse(Scenario.objects.exists())
+
+
+class TelegramDeliveryTests(SimpleTestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        self.delivery = TelegramDelivery(pool_size=4)
+        self.addCleanup(self.delivery.close)
+
+    def test_result_flows_back_to_the_caller(self):
+        sent = mock.AsyncMock(return_value="message")
+        with mock.patch("telegram.Bot.send_message", sent):
+            result = self.delivery.send("1:token", "send_message", chat_id=5, text="Hi")
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.unwrap(), "message")
+        sent.assert_awaited_once_with(chat_id=5, text="Hi")
+        self.assertEqual(self.delivery.stats()["calls"], 1)
+
+    def test_failure_is_returned_not_lost(self):
+        error = RuntimeError("Forbidden")
+        with mock.patch("telegram.Bot.send_message", mock.AsyncMock(side_effect=error)):
+            result = self.delivery.send("1:token", "send_message", chat_id=5, text="Hi")
+
+        self.assertFalse(result.ok)
+        self.assertIs(result.error, error)
+        self.assertEqual(self.delivery.stats()["failed"], 1)
+        with self.assertRaises(RuntimeError):
+            result.unwrap()
+
+    @override_settings(TELEGRAM_BOT_RATE=1000, TELEGRAM_CHAT_RATE=1000)
+    def test_long_text_is_sent_as_ordered_chunks(self):
+        text = "a" * 4000 + "\n" + "b" * 4090 + " " + "c" * 10
+        sent = mock.AsyncMock(side_effect=lambda **kwargs: kwargs["text"])
+        with mock.patch("telegram.Bot.send_message", sent):
+            result = self.delivery.queue_text(
+                "2:token", 7, text, reply_to_message_id=3
+            ).result()
+
+        self.assertEqual(result.unwrap(), ["a" * 4000, "b" * 4090, "c" * 10])
+        replies = [call.kwargs["reply_to_message_id"] for call in sent.await_args_list]
+        self.assertEqual(replies, [3, None, None])
+
+    @override_settings(TELEGRAM_BOT_RATE=1000, TELEGRAM_CHAT_RATE=1000)
+    def test_flood_wait_is_retried(self):
+        sent = mock.AsyncMock(side_effect=[RetryAfter(0), "message"])
+        with mock.patch("telegram.Bot.send_message", sent):
+            result = self.delivery.queue_text("3:token", 7, "Hi").result()
+
+        self.assertEqual(result.unwrap(), ["message"])
+        self.assertEqual(sent.await_count, 2)
+        self.assertEqual(self.delivery.stats()["flood_waits"], 1)
+
+    def test_split_text_keeps_short_text_whole(self):
+        self.assertEqual(split_text("Hi"), ["Hi"])
+        self.assertEqual(split_text(""), [""])
+        self.assertEqual(split_text("x" * 10, limit=4), ["xxxx", "xxxx", "xx"])
+
+
+class TokenBucketLimiterTests(SimpleTestCase):
+    def setUp(self):
+        directory = use_temporary_store(self)
+        self.limiter = TokenBucketLimiter(f"{directory}/limits.sqlite3")
+        self.addCleanup(self.limiter.close)
+
+    def test_empty_bucket_delays_then_rejects(self):
+        with mock.patch("bot.rate_limit.time.time", return_value=1000.0):
+            waits = [self.limiter.reserve("key", 60, 1.5, burst=2) for _ in range(3)]
+            with self.assertRaises(RateLimitExceeded):
+                self.limiter.reserve("key", 60, 1.5, burst=2)
+        self.assertEqual(waits, [0.0, 0.0, 1.0])
+
+        # Two seconds refill two tokens, one of them was promised already
+        with mock.patch("bot.rate_limit.time.time", return_value=1002.0):
+            self.assertEqual(self.limiter.reserve("key", 60, 1.5, burst=2), 0.0)
+        self.assertEqual(self.limiter.reserve("other", 60, 0), 0.0)
+
+        stats = self.limiter.stats("key")
+        self.assertEqual(
+            (stats["acquired"], stats["delayed"], stats["rejected"]), (4, 1, 1)
+        )
+        self.assertEqual(stats["total_wait_seconds"], 1.0)
+
+    def test_async_wait_reserves_off_the_event_loop(self):
+        threads = []
+        reserve = self.limiter.reserve
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return reserve(*args)
+
+        with mock.patch.object(self.limiter, "reserve", side_effect=record):
+            asyncio.run(self.limiter.aacquire("key", 60, 1))
+
+        self.assertIsNot(threads[0], threading.current_thread())
+
+
+class AsyncPipelineTests(TestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        scenario = Scenario.objects.create(name="Flow", owner=owner)
+        ask = Step.objects.create(
+            scenario=scenario, name="ask", step_type="question", content="?", order=2
+        )
+        scenario.initial_step = Step.objects.create(
+            scenario=scenario,
+            name="hello",
+            step_type="message",
+            content="Hi!",
+            order=1,
+            next_step=ask,
+        )
+        scenario.save()
+        bot = Bot.objects.create(
+            name="bot", owner=owner, token="4:async", scenario=scenario
+        )
+        BotSettings.objects.create(
+            bot=bot, mistral_api_key="key", max_requests_per_minute=0
+        )
+        self.handler = TelegramBotHandler(
+            Bot.objects.select_related("settings", "scenario").get(pk=bot.pk)
+        )
+
+    def update(self, update_id, text):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": 5, "type": "private"},
+                "text": text,
+            },
+        }
+
+    async def test_updates_are_answered_without_blocking_calls(self):
+        outbound = mock.Mock()
+        outbound.send_message = mock.AsyncMock(return_value=mock.Mock(message_id=1))
+        completion = mock.AsyncMock(return_value="LLM")
+
+        with (
+            mock.patch("bot.telegram_handler.get_delivery") as delivery,
+            mock.patch.object(MistralAPIClient, "achat_completion", completion),
+            mock.patch.object(MistralAPIClient, "chat_completion") as blocking,
+        ):
+            delivery().outbound.return_value = outbound
+            for update_id, text in enumerate(["hello", "a question"], start=1):
+                await self.handler.ahandle_update(self.update(update_id, text))
+
+        answers = [call.kwargs["text"] for call in outbound.send_message.call_args_list]
+        self.assertEqual(answers, ["Hi!", "LLM"])
+        blocking.assert_not_called()
+        self.assertEqual(
+            [
+                (message.user_message, message.bot_message)
+                async for message in Message.objects.order_by("pk")
+            ],
+            [("hello", "Hi!"), ("a question", "LLM")],
+        )
+
+    @override_settings(TELEGRAM_STREAM_EDIT_INTERVAL=0)
+    async def test_failed_partial_edits_do_not_cut_the_answer(self):
+        self.handler.bot.settings.stream_responses = True
+
+        async def stream(client, **kwargs):
+            for chunk in ["The ", "answer ", "is 42"]:
+                yield chunk
+
+        outbound = mock.Mock()
+        outbound.send_message = mock.AsyncMock(
+            side_effect=[
+                mock.Mock(message_id=1),
+                NetworkError("connection reset"),
+                mock.Mock(message_id=2),
+            ]
+        )
+        outbound.edit_message_text = mock.AsyncMock(
+            side_effect=[BadRequest("Message can't be edited"), mock.Mock()]
+        )
+
+        with (
+            mock.patch("bot.telegram_handler.get_delivery") as delivery,
+            mock.patch.object(MistralAPIClient, "astream_chat_completion", stream),
+        ):
+            delivery().outbound.return_value = outbound
+            for update_id, text in enumerate(["hello", "a question"], start=1):
+                await self.handler.ahandle_update(self.update(update_id, text))
+
+        self.assertEqual(
+            outbound.edit_message_text.call_args.args[0], "The answer is 42"
+        )
+        message = await Message.objects.aget(user_message="a question")
+        self.assertEqual(message.bot_message, "The answer is 42")
+
+
+class TelegramBotHandlerTests(SimpleTestCase):
+    def test_answer_waiting_for_flood_limits_is_not_an_error(self):
+        handler = TelegramBotHandler(Bot(name="bot", token="1:token"))
+        handler.mistral_service = mock.Mock()
+
+        def run(coroutine, timeout=None):
+            coroutine.close()
+            if timeout is not None:
+                raise concurrent.futures.TimeoutError
+
+        with (
+            mock.patch.object(
+                ScenarioProcessor, "process_message", return_value="answer"
+            ),
+            mock.patch("bot.telegram_handler.get_delivery") as delivery,
+        ):
+            delivery().run.side_effect = run
+            handler._process_message(5, "a question", raise_errors=True)
+
+        # The answer stays queued, no error message is sent after it
+        delivery().queue_text.assert_not_called()
+
+    async def test_failed_callback_answer_is_reported(self):
+        handler = TelegramBotHandler(Bot(name="bot", token="1:token"))
+        failed = concurrent.futures.Future()
+        failed.set_result(
+            DeliveryResult(ok=False, error=BadRequest("Query is too old"))
+        )
+        callback_query = mock.Mock(id="7", data="noop")
+
+        with mock.patch("bot.telegram_handler.get_delivery") as delivery:
+            delivery().call.return_value = failed
+            with self.assertLogs("bot.telegram_handler", "ERROR") as logs:
+                await handler._aprocess_callback(callback_query)
+
+        self.assertIn("Query is too old", logs.output[0])
+
+
+@override_settings(TELEGRAM_BOT_RATE=1000, TELEGRAM_CHAT_RATE=1000)
+class BroadcastTests(TestCase):
+    def setUp(self):
+        use_temporary_store(self)
+        delivery = TelegramDelivery(pool_size=4)
+        self.addCleanup(delivery.close)
+        patcher = mock.patch("bot.broadcast.get_delivery", return_value=delivery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        owner = User.objects.create(username="owner")
+        self.bot = Bot.objects.create(name="bot", owner=owner, token="9:broadcast")
+        for chat_id in range(1, 6):
+            Conversation.objects.create(bot=self.bot, user_identifier=str(chat_id))
+        Conversation.objects.create(
+            bot=self.bot, user_identifier="100", is_active=False
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def send(self, chat_id, text, **kwargs):
+        if chat_id == "3":
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+        return chat_id
+
+    def test_sends_to_active_conversations(self):
+        response = self.client.post(
+            f"/api/bots/{self.bot.pk}/broadcasts/", {"text": "News"}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["total"], 5)
+
+        sent = mock.AsyncMock(side_effect=self.send)
+        job = BroadcastJob.objects.get(pk=response.data["id"])
+        with mock.patch("telegram.Bot.send_message", sent):
+            job = run_broadcast(job, concurrency=2, batch_size=2)
+
+        self.assertEqual((job.status, job.sent, job.failed), ("completed", 4, 1))
+        chats = sorted(call.kwargs["chat_id"] for call in sent.await_args_list)
+        self.assertEqual(chats, ["1", "2", "3", "4", "5"])
+        self.assertEqual(job.eta_seconds, 0)
+
+    @mock.patch("bot.broadcast.CHECKPOINT_INTERVAL", 0)
+    def test_checkpoint_follows_finished_sends(self):
+        job = BroadcastJob.objects.create(bot=self.bot, text="News")
+        checkpoints = []
+
+        sent = mock.AsyncMock(side_effect=self.send)
+        with mock.patch("telegram.Bot.send_message", sent):
+            run_broadcast(
+                job,
+                concurrency=1,
+                on_progress=lambda job: checkpoints.append(
+                    (job.last_conversation_id, job.sent + job.failed)
+                ),
+            )
+
+        # One checkpoint per send, not one per batch of 500
+        recipients = Conversation.objects.filter(is_active=True).order_by("pk")
+        self.assertEqual(
+            checkpoints, [(c.pk, n) for n, c in enumerate(recipients, start=1)]
+        )
+
+    def test_resumes_after_checkpoint(self):
+        checkpoint = Conversation.objects.get(user_identifier="3").pk
+        job = BroadcastJob.objects.create(
+            bot=self.bot, text="News", status="running", last_conversation_id=checkpoint
+        )
+
+        sent = mock.AsyncMock(side_effect=self.send)
+        with mock.patch("telegram.Bot.send_message", sent):
+            job = run_broadcast(job)
+
+        chats = sorted(call.kwargs["chat_id"] for call in sent.await_args_list)
+        self.assertEqual(chats, ["4", "5"])
+        self.assertEqual(job.status, "completed")
+
+    def test_cancel_and_list(self):
+        job = BroadcastJob.objects.create(bot=self.bot, text="News")
+        response = self.client.post(
+            f"/api/bots/{self.bot.pk}/broadcasts/{job.pk}/cancel/"
+        )
+        self.assertEqual(response.data["status"], "cancelled")
+
+        response = self.client.get(f"/api/bots/{self.bot.pk}/broadcasts/")
+        self.assertEqual([item["id"] for item in response.data], [job.pk])
+
+
+class UpdateDedupTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f"{directory.name}/seen.sqlite3"
+        self.dedup = UpdateDeduplicator(SeenUpdates(self.path, window=10), window=10)
+
+    def test_redelivery_is_dropped(self):
+        self.assertTrue(self.dedup.claim("1:token", {"update_id": 5}))
+        self.assertFalse(self.dedup.claim("1:token", {"update_id": 5}))
+        self.assertTrue(self.dedup.claim("2:token", {"update_id": 5}))
+        self.assertTrue(self.dedup.claim("1:token", {}))
+
+        # Another process, or this one after a restart
+        other = UpdateDeduplicator(SeenUpdates(self.path, window=10), window=10)
+        self.assertFalse(other.claim("1:token", {"update_id": 5}))
+        self.assertTrue(other.claim("1:token", {"update_id": 4}))
+
+    def test_ids_below_the_window_count_as_seen(self):
+        self.dedup.claim("1:token", {"update_id": 100})
+        self.assertFalse(self.dedup.claim("1:token", {"update_id": 90}))
+        self.assertTrue(self.dedup.claim("1:token", {"update_id": 91}))
+
+    def test_released_update_is_accepted_again(self):
+        self.dedup.claim("1:token", {"update_id": 5})
+        self.dedup.release("1:token", {"update_id": 5})
+        self.assertTrue(self.dedup.claim("1:token", {"update_id": 5}))
+
+    @override_settings(BOT_INGESTION_MODE="sync")
+    def test_webhook_handles_an_update_once(self):
+        owner = User.objects.create(username="owner")
+        Bot.objects.create(name="bot", owner=owner, token="7:webhook")
+        update = {"update_id": 1, "message": {"text": "Hi"}}
+
+        with mock.patch("bot.views.get_update_dedup", return_value=self.dedup):
+            with mock.patch(
+                "bot.telegram_handler.TelegramBotHandler.handle_update"
+            ) as handle:
+                for _ in range(2):
+                    response = self.client.post(
+                        "/api/webhook/telegram/7:webhook/",
+                        update,
+                        content_type="application/json",
+                    )
+                    self.assertEqual(response.status_code, 200)
+
+        handle.assert_called_once_with(update)
+        self.assertEqual(response.json(), {"status": "duplicate"})
+
+    def test_unknown_token_is_not_recorded(self):
+        with mock.patch("bot.views.get_update_dedup", return_value=self.dedup):
+            for update_id in range(3):
+                response = self.client.post(
+                    f"/api/webhook/telegram/{update_id}:unknown/",
+                    {"update_id": update_id},
+                    content_type="application/json",
+                )
+                self.assertEqual(response.status_code, 404)
+
+        self.assertEqual(self.dedup.stats()["bots"], 0)
+        self.assertIsNone(
+            self.dedup.store.connection.execute("SELECT 1 FROM high_water").fetchone()
+        )
+
+
+class PollingTests(TestCase):
+    def setUp(self):
+        directory = use_temporary_store(self)
+        self.offsets = PollingOffsets(f"{directory}/offsets.sqlite3")
+        self.addCleanup(self.offsets.close)
+
+    def update(self, update_id, chat_id):
+        return {
+            "update_id": update_id,
+            "message": {"message_id": update_id, "chat": {"id": chat_id}},
+        }
+
+    def test_offset_is_forgotten_with_a_new_token(self):
+        self.assertEqual(self.offsets.get(1, "1:old"), 0)
+        self.offsets.set(1, "1:old", 42)
+        self.assertEqual(self.offsets.get(1, "1:old"), 42)
+        self.assertEqual(self.offsets.get(1, "1:new"), 0)
+
+    async def test_batch_is_handled_per_chat_then_offset_moves(self):
+        batches = [[self.update(10, 1), self.update(11, 2), self.update(12, 1)]]
+        offsets = []
+
+        async def post(url, json):
+            offsets.append(json["offset"])
+            if not batches:
+                raise asyncio.CancelledError
+            return mock.Mock(json=lambda: {"ok": True, "result": batches.pop()})
+
+        handled = []
+
+        async def dispatch(token, update):
+            handled.append(update["update_id"])
+            return True
+
+        client = mock.Mock(post=post)
+        self.offsets.set(3, "3:poll", 10)
+        with mock.patch("bot.polling.dispatch_update", side_effect=dispatch):
+            with self.assertRaises(asyncio.CancelledError):
+                await BotPoller(3, "3:poll", client, self.offsets).run()
+
+        self.assertEqual(offsets, [10, 13])
+        self.assertEqual(self.offsets.get(3, "3:poll"), 13)
+        self.assertLess(handled.index(10), handled.index(12))
+
+    async def test_refresh_follows_the_active_bots(self):
+        owner = await User.objects.acreate(username="owner")
+        bots = [
+            await Bot.objects.acreate(name=name, owner=owner, token=token)
+            for name, token in [("one", "1:poll"), ("two", "2:poll")]
+        ]
+
+        async def post(url, json):
+            # getUpdates висит до отмены поллера
+            await asyncio.Event().wait()
+
+        client = mock.Mock(post=post)
+        supervisor = PollingSupervisor()
+
+        await supervisor.refresh(client)
+        self.assertEqual(set(supervisor.tasks), {(bot.pk, bot.token) for bot in bots})
+        first = supervisor.tasks[(bots[0].pk, "1:poll")]
+
+        await Bot.objects.filter(pk=bots[0].pk).aupdate(is_active=False)
+        await Bot.objects.filter(pk=bots[1].pk).aupdate(token="2:new")
+        await supervisor.refresh(client)
+
+        self.assertEqual(set(supervisor.tasks), {(bots[1].pk, "2:new")})
+        await asyncio.gather(first, return_exceptions=True)
+        self.assertTrue(first.cancelled())
+        for task in supervisor.tasks.values():
+            task.cancel()
+        await asyncio.gather(*supervisor.tasks.values(), return_exceptions=True)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f"{directory.name}/flights.sqlite3"
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_call(self):
+        self.calls += 1
+        self.release.wait(5)
+        return "answer"
+
+    def run_callers(self, flights, count):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda flight=flight: results.append(
+                    flight.do("key", self.slow_call)
+                )
+            )
+            for flight in flights
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        # Wait until every other caller has joined the first one
+        while sum(flight.stats()["coalesced"] for flight in flights) < (
+            len(threads) - len(flights)
+        ):
+            threading.Event().wait(0.01)
+        return threads, results
+
+    def test_concurrent_calls_share_one_request(self):
+        flight = SingleFlight()
+        threads, results = self.run_callers([flight], 5)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ["answer"] * 5)
+        self.assertEqual(flight.stats()["coalesced"], 4)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+        # A later call is a new request, not a cached answer
+        self.assertEqual(flight.do("key", self.slow_call), "answer")
+        self.assertEqual(self.calls, 2)
+
+    def test_processes_share_through_the_store(self):
+        processes = [
+            SingleFlight(SharedFlights(self.path), poll_interval=0.01) for _ in range(2)
+        ]
+        joined = threading.Event()
+        lead = processes[1].shared.lead
+
+        def lead_and_signal(*args):
+            started_at = lead(*args)
+            joined.set()
+            return started_at
+
+        processes[1].shared.lead = lead_and_signal
+        threads, results = self.run_callers(processes[:1], 1)
+        while not self.calls:
+            threading.Event().wait(0.01)
+        follower = threading.Thread(
+            target=lambda: results.append(processes[1].do("key", self.slow_call))
+        )
+        follower.start()
+        joined.wait(5)
+        self.release.set()
+        for thread in threads + [follower]:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ["answer", "answer"])
+        self.assertEqual(processes[1].stats()["coalesced_shared"], 1)
+
+    def test_failed_call_ends_the_flight(self):
+        flight = SingleFlight(SharedFlights(self.path))
+
+        def failing_call():
+            raise RuntimeError("upstream down")
+
+        with self.assertRaises(RuntimeError):
+            flight.do("key", failing_call)
+        # The failed flight is not left behind for other processes
+        self.assertEqual(flight.do("key", lambda: "answer"), "answer")
+
+    def test_async_leader_uses_the_store_off_the_event_loop(self):
+        flight = SingleFlight(SharedFlights(self.path))
+        threads = []
+        for name in ("lead", "land"):
+            method = getattr(flight.shared, name)
+
+            def record(*args, method=method):
+                threads.append(threading.current_thread())
+                return method(*args)
+
+            setattr(flight.shared, name, record)
+
+        async def call():
+            return "answer"
+
+        self.assertEqual(asyncio.run(flight.ado("key", call)), "answer")
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+@mock.patch("bot.update_queue.close_old_connections", mock.Mock())
+class UpdateQueueTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = UpdateQueue(
+            f"{directory.name}/updates.sqlite3", max_depth=2, max_attempts=3
+        )
+        self.addCleanup(self.queue.close)
+        owner = User.objects.create(username="owner")
+        bot = Bot.objects.create(name="bot", owner=owner, token="5:queue")
+        BotSettings.objects.create(bot=bot, mistral_api_key="key")
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    def update(self, update_id, chat_id=1):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": f"m{update_id}",
+            },
+        }
+
+    def test_failed_update_is_retried_in_place(self):
+        self.queue.put("5:queue", json.dumps(self.update(1)))
+        dispatcher = UpdateDispatcher(self.queue, workers=1, retry_delay=0)
+        flaky = mock.patch.object(
+            ScenarioProcessor,
+            "process_message",
+            side_effect=[RuntimeError("db down"), "ok"],
+        )
+
+        with (
+            flaky as processed,
+            mock.patch("bot.telegram_handler.get_delivery") as delivery,
+        ):
+            delivery().run.side_effect = lambda coroutine, *args: coroutine.close()
+            (row,) = self.queue.claim()
+            dispatcher._handle(row[0], row[1], json.loads(row[2]), row[3])
+
+        self.assertEqual(processed.call_count, 2)
+        # Only the answer of the successful attempt was sent
+        delivery().queue_text.assert_not_called()
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_chat_order_survives_a_retry(self):
+        handled = []
+        failed = set()
+
+        def process(bot_token, update_data, raise_errors=False):
+            update_id = update_data["update_id"]
+            if update_id == 1 and update_id not in failed:
+                failed.add(update_id)
+                raise RuntimeError("flaky")
+            handled.append((update_data["message"]["chat"]["id"], update_id))
+
+        self.queue.max_depth = 10
+        for update_id, chat_id in [(1, 1), (2, 2), (3, 1), (4, 2), (5, 1)]:
+            self.queue.put("5:queue", json.dumps(self.update(update_id, chat_id)))
+
+        dispatcher = UpdateDispatcher(
+            self.queue, workers=2, poll_interval=0.01, retry_delay=0.05
+        )
+        with mock.patch("bot.update_queue.process_update", side_effect=process):
+            dispatcher.start()
+            while self.queue.depth():
+                threading.Event().wait(0.01)
+            dispatcher.stop(timeout=5)
+
+        self.assertEqual([u for chat, u in handled if chat == 1], [1, 3, 5])
+        self.assertEqual([u for chat, u in handled if chat == 2], [2, 4])
+
+    def test_stuck_shard_does_not_stall_other_chats(self):
+        dispatcher = UpdateDispatcher(
+            self.queue, workers=2, shard_capacity=1, poll_interval=0.01
+        )
+        stuck_chat = 1
+        other_chat = next(
+            chat_id
+            for chat_id in range(2, 100)
+            if dispatcher.ring.shard_for(f"5:queue:{chat_id}")
+            != dispatcher.ring.shard_for(f"5:queue:{stuck_chat}")
+        )
+        release = threading.Event()
+        other_done = threading.Event()
+        handled = []
+
+        def process(bot_token, update_data, raise_errors=False):
+            chat_id = update_data["message"]["chat"]["id"]
+            if chat_id == stuck_chat:
+                release.wait(5)
+            handled.append(update_data["update_id"])
+            if chat_id == other_chat:
+                other_done.set()
+
+        self.queue.max_depth = 10
+        # The stuck chat fills its shard, the other chat comes last
+        for update_id, chat_id in enumerate([stuck_chat] * 3 + [other_chat], 1):
+            self.queue.put("5:queue", json.dumps(self.update(update_id, chat_id)))
+
+        with mock.patch("bot.update_queue.process_update", side_effect=process):
+            dispatcher.start()
+            self.assertTrue(other_done.wait(5))
+            release.set()
+            while self.queue.depth():
+                threading.Event().wait(0.01)
+            dispatcher.stop(timeout=5)
+
+        self.assertEqual(handled[0], 4)
+        self.assertEqual(handled[1:], [1, 2, 3])
+
+    @override_settings(BOT_INGESTION_MODE="queue")
+    def test_webhook_queues_known_bots_only(self):
+        dedup = UpdateDeduplicator(SeenUpdates(":memory:"))
+        with mock.patch("bot.views.get_update_queue", return_value=self.queue):
+            with mock.patch("bot.views.get_update_dedup", return_value=dedup):
+                statuses = [
+                    self.client.post(
+                        f"/api/webhook/telegram/{token}/",
+                        self.update(update_id),
+                        content_type="application/json",
+                    ).status_code
+                    for token, update_id in [
+                        ("0:unknown", 1),
+                        ("5:queue", 2),
+                        ("5:queue", 3),
+                        ("5:queue", 4),
+                    ]
+                ]
+
+        self.assertEqual(statuses, [404, 200, 200, 429])
+        self.assertEqual(self.queue.depth(), 2)
+        rows = self.queue.claim(limit=10)
+        self.assertEqual([json.loads(row[2])["update_id"] for row in rows], [2, 3])
+        self.queue.ack(rows[0][0])
+        self.assertEqual(self.queue.depth(), 1)
@@ -0,0 +1,318 @@
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+from queue import Queue
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .local_store import LocalStore, store_path
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue(LocalStore):
+    """Durable journal of raw Telegram updates waiting to be processed"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS updates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bot_token TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_at REAL,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS queue_depth (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        depth INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO queue_depth (id, depth) VALUES (1, 0);
+    """
+    # Обновление подтверждено Telegram только после записи на диск
+    synchronous = "FULL"
+
+    def __init__(self, path, max_depth=10000, max_attempts=5):
+        super().__init__(path)
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+
+    def put(self, bot_token, payload):
+        """Append update to the journal, False when the queue is full"""
+        with self.transaction() as conn:
+            (depth,) = conn.execute("SELECT depth FROM queue_depth").fetchone()
+            if depth >= self.max_depth:
+                return False
+            conn.execute(
+                "INSERT INTO updates (bot_token, payload, created_at) VALUES (?, ?, ?)",
+                (bot_token, payload, time.time()),
+            )
+            conn.execute("UPDATE queue_depth SET depth = depth + 1")
+        return True
+
+    def claim(self, limit=1):
+        """Lease the oldest unclaimed updates to the dispatcher"""
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, bot_token, payload, attempts FROM updates "
+                "WHERE claimed_at IS NULL ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE updates SET claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                [(now, row[0]) for row in rows],
+            )
+        return rows
+
+    def unclaimed(self, after_id=0, limit=1):
+        """Unclaimed updates above after_id in journal order, not leased"""
+        return self.connection.execute(
+            "SELECT id, bot_token, payload, attempts FROM updates "
+            "WHERE claimed_at IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+
+    def lease(self, update_ids):
+        """Claim the given updates, see unclaimed"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE updates SET claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                [(time.time(), update_id) for update_id in update_ids],
+            )
+
+    def ack(self, update_id):
+        """Remove processed update from the journal"""
+        with self.transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM updates WHERE id = ?", (update_id,)
+            ).rowcount
+            conn.execute("UPDATE queue_depth SET depth = depth - ?", (deleted,))
+
+    def add_attempt(self, update_id):
+        """Count one more attempt of a claimed update that is retried"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE updates SET attempts = attempts + 1 WHERE id = ?", (update_id,)
+            )
+
+    def reset_claims(self):
+        """Release leases left over by a dispatcher that did not shut down"""
+        with self.transaction() as conn:
+            conn.execute("UPDATE updates SET claimed_at = NULL")
+
+    def depth(self):
+        (depth,) = self.connection.execute("SELECT depth FROM queue_depth").fetchone()
+        return depth
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_update_queue():
+    """Process-wide UpdateQueue configured from settings"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = UpdateQueue(
+                    store_path(settings.BOT_UPDATE_QUEUE_FILE),
+                    max_depth=settings.BOT_UPDATE_QUEUE_MAX_DEPTH,
+                )
+    return _queue
+
+
+def process_update(bot_token, update_data, raise_errors=False):
+    """Run the regular webhook pipeline for one stored update
+
+    With raise_errors a failed update raises, see handle_update.
+    """
+    from .registry import registry
+
+    bundle = registry.get(bot_token)
+    if bundle is None:
+        logger.warning("Skipping update for unknown or inactive bot")
+        return
+    bundle.handler.handle_update(update_data, raise_errors)
+
+
+def chat_key(bot_token, update_data):
+    """Ordering key of an update: updates with equal keys must not overlap"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in update_data:
+            return f"{bot_token}:{update_data[field]['chat']['id']}"
+    callback_query = update_data.get("callback_query")
+    if callback_query and callback_query.get("message"):
+        return f"{bot_token}:{callback_query['message']['chat']['id']}"
+    return bot_token
+
+
+class HashRing:
+    """Consistent hashing of ordering keys onto shard numbers"""
+
+    def __init__(self, shards, replicas=64):
+        self._points = []
+        self._shards = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                point = self._hash(f"{shard}:{replica}")
+                index = bisect.bisect(self._points, point)
+                self._points.insert(index, point)
+                self._shards.insert(index, shard)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._shards[index]
+
+
+class UpdateDispatcher:
+    """Drains the update queue in journal order across sharded worker threads
+
+    Every chat is pinned to one shard, so its updates are processed strictly
+    one after another, while different chats run in parallel. A failed
+    update is retried in place, holding up its shard, so later updates of
+    the chat never overtake it; the other shards keep being fed meanwhile.
+    The dispatcher must be the only consumer of its queue.
+    """
+
+    def __init__(
+        self,
+        queue,
+        workers=4,
+        shard_capacity=100,
+        poll_interval=0.2,
+        retry_delay=1.0,
+    ):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.ring = HashRing(workers)
+        self._shards = [Queue(maxsize=shard_capacity) for _ in range(workers)]
+        self._routes = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self.queue.reset_claims()
+        for number, shard in enumerate(self._shards):
+            thread = threading.Thread(
+                target=self._work, args=(shard,), name=f"update-shard-{number}"
+            )
+            thread.start()
+            self._threads.append(thread)
+        reader = threading.Thread(target=self._read, name="update-reader")
+        reader.start()
+        self._threads.append(reader)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _read(self):
+        while not self._stop.is_set():
+            if not self._feed():
+                self._stop.wait(self.poll_interval)
+        for shard in self._shards:
+            shard.put(None)
+        self.queue.close()
+
+    def _feed(self):
+        """Hand unclaimed updates to the shards with room, in journal order
+
+        The updates of a full shard stay unclaimed in the journal, so they
+        cannot overtake the ones it holds, while the other shards are fed
+        past them. Returns whether any update was handed out.
+        """
+        # Места в шардах только освобождаются, пока читатель их заполняет
+        room = [shard.maxsize - shard.qsize() for shard in self._shards]
+        after_id = 0
+        fed = False
+        while any(room):
+            rows = self.queue.unclaimed(after_id, limit=self.workers * 10)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            batch = []
+            for update_id, bot_token, payload, attempts in rows:
+                number = self._route(update_id, bot_token, payload)
+                if number is None or not room[number]:
+                    continue
+                room[number] -= 1
+                batch.append((number, update_id, bot_token, payload, attempts))
+            if not batch:
+                continue
+            self.queue.lease([update_id for _, update_id, *_ in batch])
+            for number, update_id, bot_token, payload, attempts in batch:
+                del self._routes[update_id]
+                self._shards[number].put_nowait(
+                    (update_id, bot_token, json.loads(payload), attempts)
+                )
+            fed = True
+        return fed
+
+    def _route(self, update_id, bot_token, payload):
+        """Shard number of a journaled update, None for a malformed one"""
+        if update_id not in self._routes:
+            try:
+                update_data = json.loads(payload)
+            except ValueError:
+                logger.error(f"Dropping malformed update {update_id}")
+                self.queue.ack(update_id)
+                return None
+            # Обновления, ждущие места в шарде, не разбираются повторно
+            self._routes[update_id] = self.ring.shard_for(
+                chat_key(bot_token, update_data)
+            )
+        return self._routes[update_id]
+
+    def _work(self, shard):
+        while True:
+            item = shard.get()
+            if item is None:
+                break
+            self._handle(*item)
+        self.queue.close()
+
+    def _handle(self, update_id, bot_token, update_data, attempts):
+        # claim() уже засчитал текущую попытку
+        attempt = attempts + 1
+        while True:
+            close_old_connections()
+            try:
+                # Последняя попытка отвечает пользователю сообщением об ошибке
+                process_update(
+                    bot_token,
+                    update_data,
+                    raise_errors=attempt < self.queue.max_attempts,
+                )
+            except Exception as e:
+                logger.error(f"Error processing queued update {update_id}: {e}")
+                if attempt >= self.queue.max_attempts:
+                    logger.error(
+                        f"Dropping update {update_id} after {attempt} attempts"
+                    )
+                    self.queue.ack(update_id)
+                    return
+            else:
+                self.queue.ack(update_id)
+                return
+            finally:
+                close_old_connections()
+
+            self.queue.add_attempt(update_id)
+            attempt += 1
+            # При остановке обновление остается в журнале до следующего запуска
+            if self._stop.wait(min(self.retry_delay * 2 ** (attempt - 2), 30)):
+                return
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from . import views
@@ -11,9 +12,13 @@ router.register(r"settings", views.BotSettingsViewSet, basename="botsettings")
 
 urlpatterns = [
     path("", include(router.urls)),
+    path("stats/", views.runtime_stats, name="runtime_stats"),
+    path("export/messages/", views.export_messages, name="export_messages"),
     path(
         "webhook/telegram/<str:bot_token>/",
-        views.telegram_webhook,
+        views.telegram_webhook_async
+        if settings.BOT_INGESTION_MODE == "async"
+        else views.telegram_webhook,
         name="telegram_webhook",
     ),
 ]
@@ -1,20 +1,49 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from .models import Bot, Scenario, Step, BotSettings, Conversation
+from .models import (
+    Bot,
+    Scenario,
+    Step,
+    BotSettings,
+    Conversation,
+    Message,
+    BroadcastJob,
+)
+from .pagination import ConversationCursorPagination, MessageCursorPagination
 from .serializers import (
+    CONVERSATION_LIST_FIELDS,
+    MESSAGE_LIST_FIELDS,
+    ScenarioGraphSerializer,
     BotSerializer,
+    BroadcastJobSerializer,
     ScenarioSerializer,
     StepSerializer,
     BotSettingsSerializer,
     ConversationSerializer,
+    MessageSerializer,
     StepCreateSerializer,
 )
+from .archive import MessageArchive
+from .dedup import get_update_dedup
+from .delivery import get_delivery
+from .export import export_rows, gzipped, ndjson, parse_time
 from .telegram_handler import TelegramBotHandler
+from .rate_limit import bot_quota_key, get_rate_limiter
+from .registry import registry
+from .response_cache import get_response_cache
+from .services import system_prompts
+from .single_flight import get_single_flight
+from .update_queue import get_update_queue
 
 # Webhook view for Telegram
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 import json
 
 
@@ -22,27 +51,143 @@ import json
 def telegram_webhook(request, bot_token):
     if request.method == "POST":
         try:
-            # Find bot by token
-            bot = Bot.objects.get(token=bot_token, is_active=True)
+            update_data = json.loads(request.body)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        # Find bot by token, nothing is recorded for unknown tokens
+        try:
+            bundle = registry.get(bot_token)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+        if bundle is None:
+            return JsonResponse({"error": "Bot not found"}, status=404)
+
+        # Telegram повторяет доставку, если ответ не пришел вовремя
+        dedup = get_update_dedup()
+        if not dedup.claim(bot_token, update_data):
+            return JsonResponse({"status": "duplicate"})
 
+        if settings.BOT_INGESTION_MODE == "queue":
+            return _enqueue_update(request, bot_token, update_data)
+        try:
             # Process the update
-            handler = TelegramBotHandler(bot)
-            handler.handle_update(json.loads(request.body))
+            bundle.handler.handle_update(update_data)
 
             return JsonResponse({"status": "ok"})
-        except Bot.DoesNotExist:
+        except Exception as e:
+            dedup.release(bot_token, update_data)
+            return JsonResponse({"error": str(e)}, status=500)
+
+    return JsonResponse({"error": "Method not allowed"}, status=405)
+
+
+@csrf_exempt
+async def telegram_webhook_async(request, bot_token):
+    """Webhook for BOT_INGESTION_MODE = "async", served by the ASGI app"""
+    if request.method == "POST":
+        try:
+            update_data = json.loads(request.body)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        try:
+            bundle = await registry.aget(bot_token)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+        if bundle is None:
             return JsonResponse({"error": "Bot not found"}, status=404)
+
+        dedup = get_update_dedup()
+        if not await sync_to_async(dedup.claim)(bot_token, update_data):
+            return JsonResponse({"status": "duplicate"})
+
+        try:
+            await bundle.handler.ahandle_update(update_data)
+
+            return JsonResponse({"status": "ok"})
         except Exception as e:
+            await sync_to_async(dedup.release)(bot_token, update_data)
             return JsonResponse({"error": str(e)}, status=500)
 
     return JsonResponse({"error": "Method not allowed"}, status=405)
 
 
+def _enqueue_update(request, bot_token, update_data):
+    """Store raw update for the worker pool and acknowledge immediately"""
+    try:
+        accepted = get_update_queue().put(bot_token, request.body.decode("utf-8"))
+    except Exception as e:
+        get_update_dedup().release(bot_token, update_data)
+        return JsonResponse({"error": str(e)}, status=500)
+
+    if not accepted:
+        get_update_dedup().release(bot_token, update_data)
+        # Очередь заполнена: Telegram повторит доставку позже
+        response = JsonResponse({"error": "Update queue is full"}, status=429)
+        response["Retry-After"] = "5"
+        return response
+    return JsonResponse({"status": "ok"})
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def runtime_stats(request):
+    """Counters of the in-process caches of the serving worker"""
+    return Response(
+        {
+            "response_cache": get_response_cache().stats(),
+            "telegram_delivery": get_delivery().stats(),
+            "update_dedup": get_update_dedup().stats(),
+            "system_prompts": system_prompts.stats(),
+            "mistral_single_flight": get_single_flight().stats(),
+        }
+    )
+
+
+@api_view(["GET"])
+def export_messages(request):
+    """Stream messages of the user's bots as NDJSON
+
+    Query parameters: bot (repeatable, defaults to all the user's bots),
+    since and until (ISO 8601), after_id to resume after the last
+    received row, gzip=1 for a compressed download.
+    """
+    bot_ids = list(Bot.objects.filter(owner=request.user).values_list("id", flat=True))
+    requested = request.query_params.getlist("bot")
+    if requested:
+        try:
+            requested = {int(bot_id) for bot_id in requested}
+        except ValueError:
+            return Response(
+                {"error": "bot must be an id"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        bot_ids = [bot_id for bot_id in bot_ids if bot_id in requested]
+
+    try:
+        since, until = (
+            parse_time(request.query_params.get(name)) for name in ("since", "until")
+        )
+        after_id = int(request.query_params.get("after_id") or 0)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    stream = ndjson(export_rows(bot_ids, since, until, after_id))
+    if request.query_params.get("gzip") in ("1", "true"):
+        response = StreamingHttpResponse(
+            gzipped(stream), content_type="application/gzip"
+        )
+        response["Content-Disposition"] = 'attachment; filename="messages.ndjson.gz"'
+    else:
+        response = StreamingHttpResponse(stream, content_type="application/x-ndjson")
+    return response
+
+
 class BotViewSet(viewsets.ModelViewSet):
     serializer_class = BotSerializer
 
     def get_queryset(self):
-        return Bot.objects.filter(owner=self.request.user)
+        return Bot.objects.filter(owner=self.request.user).select_related(
+            "settings", "scenario"
+        )
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
@@ -61,6 +206,52 @@ class BotViewSet(viewsets.ModelViewSet):
         bot.save()
         return Response({"status": "bot deactivated"})
 
+    @action(detail=True, methods=["get"])
+    def rate_limit(self, request, pk=None):
+        bot = self.get_object()
+        stats = get_rate_limiter().stats(bot_quota_key(bot))
+        stats["max_requests_per_minute"] = (
+            bot.settings.max_requests_per_minute if hasattr(bot, "settings") else None
+        )
+        return Response(stats)
+
+    @action(detail=True, methods=["get", "post"])
+    def broadcasts(self, request, pk=None):
+        """List the bot's broadcast jobs or create one from {"text": ...}
+
+        Jobs are sent by the run_broadcasts command.
+        """
+        bot = self.get_object()
+        if request.method == "GET":
+            jobs = BroadcastJob.objects.filter(bot=bot).order_by("-id")
+            return Response(BroadcastJobSerializer(jobs, many=True).data)
+
+        if bot.bot_type != "telegram":
+            return Response(
+                {"error": "Only telegram bots support broadcasts"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        serializer = BroadcastJobSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(
+            bot=bot,
+            total=Conversation.objects.filter(bot=bot, is_active=True).count(),
+        )
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(
+        detail=True,
+        methods=["post"],
+        url_path=r"broadcasts/(?P<job_id>\d+)/cancel",
+    )
+    def cancel_broadcast(self, request, pk=None, job_id=None):
+        bot = self.get_object()
+        BroadcastJob.objects.filter(
+            pk=job_id, bot=bot, status__in=["pending", "running"]
+        ).update(status="cancelled", finished_at=timezone.now())
+        job = get_object_or_404(BroadcastJob, pk=job_id, bot=bot)
+        return Response(BroadcastJobSerializer(job).data)
+
     @action(detail=True, methods=["post"])
     def set_webhook(self, request, pk=None):
         bot = self.get_object()
@@ -149,7 +340,9 @@ class ScenarioViewSet(viewsets.ModelViewSet):
     serializer_class = ScenarioSerializer
 
     def get_queryset(self):
-        return Scenario.objects.filter(owner=self.request.user)
+        return Scenario.objects.filter(owner=self.request.user).prefetch_related(
+            "steps"
+        )
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
@@ -161,6 +354,21 @@ class ScenarioViewSet(viewsets.ModelViewSet):
         serializer = StepSerializer(steps, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["post"], url_path="import")
+    def import_graph(self, request):
+        """Create a scenario with all its steps from one document"""
+        serializer = ScenarioGraphSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        scenario = serializer.save(owner=request.user)
+        return Response(
+            ScenarioSerializer(scenario).data, status=status.HTTP_201_CREATED
+        )
+
+    @action(detail=True, methods=["get"], url_path="export")
+    def export_graph(self, request, pk=None):
+        """Scenario document in the format accepted by import"""
+        return Response(ScenarioGraphSerializer(self.get_object()).data)
+
 
 class StepViewSet(viewsets.ModelViewSet):
     serializer_class = StepCreateSerializer
@@ -175,10 +383,53 @@ class StepViewSet(viewsets.ModelViewSet):
 
 
 class ConversationViewSet(viewsets.ReadOnlyModelViewSet):
+    """Conversations of the user's bots
+
+    The list is cursor-paginated and leaves the messages out, they are
+    paged separately by the messages action. Only retrieve returns a
+    conversation with all its messages.
+    """
+
     serializer_class = ConversationSerializer
+    pagination_class = ConversationCursorPagination
 
     def get_queryset(self):
-        return Conversation.objects.filter(bot__owner=self.request.user)
+        queryset = Conversation.objects.filter(bot__owner=self.request.user)
+        if self.action == "retrieve":
+            queryset = queryset.prefetch_related("messages")
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        rows = self.get_queryset().values(*CONVERSATION_LIST_FIELDS)
+        page = self.paginate_queryset(rows)
+        return self.get_paginated_response(page)
+
+    @action(detail=True, methods=["get"])
+    def messages(self, request, pk=None):
+        """Cursor-paginated messages still in the hot table"""
+        conversation = self.get_object()
+        rows = Message.objects.filter(conversation=conversation).values(
+            *MESSAGE_LIST_FIELDS
+        )
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(rows, request, view=self)
+        return paginator.get_paginated_response(page)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Full conversation, archived messages included"""
+        conversation = self.get_object()
+        data = self.get_serializer(conversation).data
+        archived = MessageArchive(conversation.bot_id).conversation_messages(
+            conversation.pk
+        )
+        # Прерванный перенос оставляет строку и в архиве, и в таблице
+        hot_ids = {message["id"] for message in data["messages"]}
+        archived = [message for message in archived if message.id not in hot_ids]
+        if archived:
+            data["messages"] = (
+                MessageSerializer(archived, many=True).data + data["messages"]
+            )
+        return Response(data)
 
 
 class BotSettingsViewSet(viewsets.ModelViewSet):
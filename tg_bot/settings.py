@@ -45,6 +45,89 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Обработка входящих обновлений Telegram:
+# "sync" - весь конвейер выполняется в запросе вебхука,
+# "queue" - вебхук пишет обновление в локальную очередь и сразу отвечает,
+# очередь разбирает команда run_update_workers,
+# "async" - асинхронный конвейер, требует запуска под ASGI (tg_bot.asgi)
+BOT_INGESTION_MODE = "sync"
+BOT_LOCAL_STORE_DIR = BASE_DIR / "var"
+BOT_UPDATE_QUEUE_FILE = "updates.sqlite3"
+BOT_UPDATE_QUEUE_MAX_DEPTH = 10000
+BOT_UPDATE_WORKERS = 4
+
+# Команда start_bot_polling: long polling getUpdates вместо вебхуков
+TELEGRAM_API_URL = "https://api.telegram.org"
+BOT_POLLING_TIMEOUT = 50  # секунд ожидания одного getUpdates
+BOT_POLLING_REFRESH = 30  # как часто перечитывать список ботов
+BOT_POLLING_OFFSETS_FILE = "polling_offsets.sqlite3"
+
+# Повторные доставки одного update_id отбрасываются до обработки:
+# окно последних update_id каждого бота в памяти процесса и в общем файле
+BOT_UPDATE_DEDUP_WINDOW = 1000
+BOT_UPDATE_DEDUP_FILE = "seen_updates.sqlite3"
+
+# Реестр ботов по токену вебхука; изменения из других процессов
+# становятся видны не позже чем через BOT_REGISTRY_TTL секунд
+BOT_REGISTRY_TTL = 60
+
+# Последние сообщения диалогов для контекста Mistral хранятся в кэше
+# Django; буфер сверяется с id последнего сообщения диалога, поэтому кэш
+# процесса не теряет ходы, записанные другими процессами
+BOT_HISTORY_CACHE = "default"
+# Окно истории; сколько из него попадет в запрос, решает
+# context_token_budget бота
+BOT_HISTORY_SIZE = 20  # обменов, по строке Message на каждый
+BOT_HISTORY_TTL = 24 * 60 * 60
+
+# Архив старых сообщений (команда archive_messages): gzip NDJSON по
+# месяцам внутри BOT_LOCAL_STORE_DIR
+BOT_ARCHIVE_DIR = "archive"
+
+# Сериализованные сценарии в ответах /api/bots/ кэшируются по версии
+BOT_PAYLOAD_CACHE_TTL = 60 * 60
+
+# HTTP-клиент Mistral: один пул keep-alive соединений на процесс
+MISTRAL_API_URL = "https://api.mistral.ai/v1"
+MISTRAL_HTTP_POOL_SIZE = 20
+MISTRAL_ASYNC_MAX_CONNECTIONS = 500  # одновременных запросов в async-режиме
+MISTRAL_HTTP_KEEPALIVE = 60  # секунд простоя до TCP keepalive, 0 - выключить
+MISTRAL_CONNECT_TIMEOUT = 5
+MISTRAL_READ_TIMEOUT = 30
+
+# Лимит BotSettings.max_requests_per_minute общий для всех процессов;
+# запрос ждёт свободный токен не дольше MISTRAL_RATE_LIMIT_MAX_WAIT секунд
+MISTRAL_RATE_LIMIT_FILE = "rate_limits.sqlite3"
+MISTRAL_RATE_LIMIT_MAX_WAIT = 10
+
+# Кэш ответов Mistral (включается в BotSettings.cache_responses):
+# LRU в памяти процесса и, при желании, общий файл на диске
+MISTRAL_CACHE_MAX_BYTES = 32 * 1024 * 1024
+MISTRAL_CACHE_PERSISTENT = False
+MISTRAL_CACHE_FILE = "response_cache.sqlite3"
+
+# Одновременные одинаковые запросы к Mistral выполняются одним вызовом:
+# внутри процесса и, через общий файл, между процессами; ожидающий
+# другой процесс делает запрос сам через MISTRAL_SINGLE_FLIGHT_LEASE секунд
+MISTRAL_SINGLE_FLIGHT_SHARED = True
+MISTRAL_SINGLE_FLIGHT_FILE = "single_flight.sqlite3"
+MISTRAL_SINGLE_FLIGHT_LEASE = 60
+
+# Потоковые ответы: не чаще одного edit_message_text в секунду на чат
+TELEGRAM_STREAM_EDIT_INTERVAL = 1.0
+
+# Исходящие вызовы Bot API из синхронного кода: один цикл событий
+# и общий пул соединений на процесс
+TELEGRAM_POOL_SIZE = 32
+TELEGRAM_DELIVERY_TIMEOUT = 30  # секунд ожидания результата одного вызова
+
+# Лимиты Telegram на отправку: сообщений в секунду на бота и на чат.
+# Ответ 429 приостанавливает бота на retry_after, попыток на сообщение
+# не больше TELEGRAM_SEND_RETRIES
+TELEGRAM_BOT_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_SEND_RETRIES = 5
+
 # Application definition
 
 INSTALLED_APPS = [